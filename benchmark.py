@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import loader
+
+# Synthetic datasets are written here, one file per size and seed, and reused by later runs
+BENCHMARK_DIR = 'data/benchmark'
+DEFAULT_SIZES = [10_000]
+GENERATION_CHUNKSIZE = 100_000
+
+# Columns of the synthetic export, in the order of the real one, with some of the columns the loader never reads
+COLUMNS = ['nom', 'lat_coor1', 'x', 'long_coor1', 'y', 'adr_num', 'adr_voie', 'com_cp', 'com_insee', 'com_nom',
+           'tel1', 'freq_mnt', 'dermnt', 'ref', 'id']
+
+PLACES = np.array(['Ecole maternelle', 'Ecole élémentaire', 'Gymnase', 'Piscine', 'MEDIATHEQUE', 'Centre Culturel',
+                   'EHPAD', 'Poste de police', 'Maison pour tous', 'Stade'])
+PEOPLE = np.array(['Jean Macé', 'Paul-Eluard', 'Winston Churchill', 'LEO LAGRANGE', 'François Spinosi',
+                   'Michel BELORGEOT', "Aliénor-d'Aquitaine", 'Rabelais', 'Marceline Desbordes-Valmore', 'Neptune'])
+STREET_TYPES = np.array(['rue', 'avenue', 'boulevard', 'place', 'impasse', 'rond-point', 'Rue', 'allée'])
+STREET_NAMES = np.array(['albert Einstein', 'Jacques-Bounin', 'de Saint Hilaire', 'Sarrail', 'durand', 'des Moulins',
+                         'Benjamin Franklin', 'Pierre Gilles de Gennes', 'Thermidor', 'du Dr Jacques Fourcade',
+                         'du lavandin', 'de Bologne'])
+ZIP_CODES = np.array(['34000', '34070', '34080', '34090'])
+CITIES = np.array(['Montpellier', 'Montpellier', 'Montpellier', 'MONTPELLIER', 'montpellier'])
+FREQUENCIES = np.array(['tous les ans', 'Tous les ans', 'Tout les ans', 'tout les ans', 'Tous les 2 ans'])
+
+
+def _pick(rng:np.random.Generator, values:np.ndarray, n:int) -> pd.Series:
+    return pd.Series(rng.choice(values, n))
+
+
+def _numbers(rng:np.random.Generator, low:int, high:int, n:int) -> pd.Series:
+    return pd.Series(rng.integers(low, high, n)).astype(str)
+
+
+def _two_digits(rng:np.random.Generator, n:int) -> pd.Series:
+    return pd.Series(rng.integers(0, 100, n)).astype(str).str.zfill(2)
+
+
+def _with_defects(rng:np.random.Generator, clean:pd.Series, defects:list) -> pd.Series:
+    """ Replace values of a column by defective ones: defects is a list of (probability, defective values)"""
+    values = clean.copy()
+    draw = rng.random(len(values))
+    threshold = 0.0
+    for probability, defective in defects:
+        selected = (draw >= threshold) & (draw < threshold + probability)
+        values[selected] = defective[selected] if isinstance(defective, pd.Series) else defective
+        threshold += probability
+    return values
+
+
+def generate_chunk(n_rows:int, rng:np.random.Generator, start_id:int=0) -> pd.DataFrame:
+    """ Synthetic raw rows reproducing the defects of the Montpellier export (see loader_test.py)"""
+    n = n_rows
+    number = _numbers(rng, 1, 500, n)
+    street = _pick(rng, STREET_TYPES, n) + ' ' + _pick(rng, STREET_NAMES, n)
+    zip_code = _pick(rng, ZIP_CODES, n)
+    city = _pick(rng, CITIES, n)
+    phone = ' ' + _two_digits(rng, n) + ' ' + _two_digits(rng, n) + ' ' + _two_digits(rng, n) + ' ' + _two_digits(rng, n)
+    dates = pd.Series(pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 2000, n), unit='D')).dt.strftime('%Y-%m-%d')
+    blank = pd.Series(np.full(n, ' '))
+
+    df = pd.DataFrame({
+        'nom': _with_defects(rng, _pick(rng, PLACES, n) + ' ' + _pick(rng, PEOPLE, n), [(0.02, ' ')]),
+        'lat_coor1': _with_defects(rng, pd.Series(rng.uniform(3.80, 3.95, n)).map('{:.14f}'.format), [(0.05, ' ')]),
+        'x': _numbers(rng, 760000, 780000, n),
+        'long_coor1': _with_defects(rng, pd.Series(rng.uniform(43.57, 43.65, n)).map('{:.13f}'.format), [(0.05, ' ')]),
+        'y': _numbers(rng, 6270000, 6290000, n),
+        # Spaced ranges, bis, junk after the number, full address in the number field
+        'adr_num': _with_defects(rng, number, [
+            (0.10, number + ' -' + _numbers(rng, 500, 999, n)),
+            (0.10, number + ' - ' + _numbers(rng, 500, 999, n)),
+            (0.05, number + ' bis'),
+            (0.05, number + ' ' + street + ', MONTPELLIER'),
+            (0.05, '-'),
+            (0.15, ' ')]),
+        # Zip code and city inside the street, double spaces, street number, comma, dash
+        'adr_voie': _with_defects(rng, street, [
+            (0.10, street + ' ' + zip_code + ' Montpellier'),
+            (0.05, street.str.replace(' ', '  ', n=1, regex=False)),
+            (0.05, number + ' ' + street + ', MONTPELLIER'),
+            (0.05, ' ' + street),
+            (0.03, '-'),
+            (0.05, ' ')]),
+        'com_cp': _with_defects(rng, zip_code, [(0.05, '0')]),
+        'com_insee': pd.Series(np.full(n, '34172')),
+        'com_nom': _with_defects(rng, city, [(0.05, ' ')]),
+        # 334... prefixes, + prefix, double spaces, mobile numbers
+        'tel1': _with_defects(rng, '334 67' + phone, [
+            (0.10, '+334 99' + phone.str.replace(' ', '  ', n=1, regex=False)),
+            (0.05, '06' + phone),
+            (0.05, '-'),
+            (0.15, ' ')]),
+        # Misspelled and date-looking frequencies
+        'freq_mnt': _with_defects(rng, _pick(rng, FREQUENCIES, n), [(0.05, dates), (0.40, ' ')]),
+        'dermnt': _with_defects(rng, dates, [(0.02, '2019-13-45'), (0.40, ' ')]),
+        'ref': _with_defects(rng, _pick(rng, PEOPLE, n).str.upper(), [(0.5, blank)]),
+        'id': pd.Series(np.arange(start_id, start_id + n)).astype(str),
+    })
+    return df[COLUMNS]
+
+
+def generate_dirty_data(n_rows:int, path:str, seed:int=0, chunksize:int=GENERATION_CHUNKSIZE) -> str:
+    """ Write a synthetic dirty export of n_rows rows, chunk by chunk so that any size fits in memory"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for start in range(0, max(n_rows, 1), chunksize):
+            chunk = generate_chunk(min(chunksize, n_rows - start), rng, start_id=start)
+            chunk.to_csv(f, index=False, header=start == 0)
+    return path
+
+
+def dataset_path(n_rows:int, seed:int=0) -> str:
+    """ Synthetic dataset of n_rows rows, generated on first use"""
+    path = os.path.join(BENCHMARK_DIR, f'dirty_{n_rows}_{seed}.csv')
+    if not os.path.exists(path):
+        generate_dirty_data(n_rows, path, seed=seed)
+    return path
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_size(n_rows:int, seed:int=0, memory:bool=False) -> list:
+    """ Throughput of each pipeline function on a synthetic dataset of n_rows rows.
+        With memory, the pipeline is run once more under a PipelineProfile to get the peak memory of each stage.
+    """
+    path = dataset_path(n_rows, seed)
+    n_bytes = os.path.getsize(path)
+    formatted, formatting_time = _timed(loader.load_formatted_data, path)
+    sanitized, sanitizing_time = _timed(loader.sanitize_data, formatted)
+    _, framing_time = _timed(loader.frame_data, sanitized)
+    _, total_time = _timed(loader.load_clean_data, path)
+    timings = {'load_formatted_data': formatting_time, 'sanitize_data': sanitizing_time,
+               'frame_data': framing_time, 'load_clean_data': total_time}
+
+    peaks = {}
+    if memory:
+        profile = loader.PipelineProfile()
+        loader.load_clean_data(path, profile=profile)
+        peaks = {record['stage']: record['peak_bytes'] for record in profile.report()}
+
+    return [{'rows': n_rows, 'stage': stage, 'seconds': seconds,
+             'rows_per_second': n_rows / seconds if seconds else None,
+             'bytes_per_second': n_bytes / seconds if seconds else None,
+             'peak_bytes': peaks.get(stage)}
+            for stage, seconds in timings.items()]
+
+
+def run_benchmark(sizes:list=DEFAULT_SIZES, seed:int=0, memory:bool=False) -> dict:
+    """ Benchmark every size, with what is needed to compare runs made on different commits"""
+    return {'commit': _git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'seed': seed,
+            'results': [result for n_rows in sizes for result in benchmark_size(n_rows, seed, memory)]}
+
+
+# Code run in a fresh interpreter to time `import loader` alone
+IMPORT_TIMING_CODE = "import time; start = time.perf_counter(); import loader; print(time.perf_counter() - start)"
+
+
+def benchmark_startup(runs:int=5) -> dict:
+    """ Startup cost of the command line: `import loader` alone, and whole `python loader.py` runs whose outputs
+        are already up to date (the first run, which may have to write them, is not counted).
+        Each is the median over runs fresh interpreters.
+    """
+    def run(args):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, *args], capture_output=True, text=True, check=True).stdout
+        return output, time.perf_counter() - start
+
+    import_times = [float(run(['-c', IMPORT_TIMING_CODE])[0]) for _ in range(runs)]
+    run(['loader.py'])
+    main_times = [run(['loader.py'])[1] for _ in range(runs)]
+    return {'import_seconds': statistics.median(import_times),
+            'import_budget_seconds': loader.IMPORT_TIME_BUDGET,
+            'up_to_date_run_seconds': statistics.median(main_times)}
+
+
+# Queries sent by the clients of the service benchmark, in turn
+SERVICE_QUERIES = ['/defibrillators', '/defibrillators?com_cp=34070&limit=50', '/defibrillators?overdue=true&offset=200',
+                   '/defibrillators?bbox=3.85,43.60,3.90,43.62&limit=20', '/defibrillators?com_cp=34000&overdue=false&limit=10']
+DEFAULT_CLIENTS = [1, 4, 16]
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _run_clients(port:int, clients:int, requests:int, queries:list) -> dict:
+    """ requests queries sent by each of clients threads, each on its own keep-alive connection"""
+    import http.client
+    from concurrent.futures import ThreadPoolExecutor
+
+    def client(first):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        latencies, errors = [], 0
+        for i in range(requests):
+            start = time.perf_counter()
+            connection.request('GET', queries[(first + i) % len(queries)])
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            errors += response.status != 200
+        connection.close()
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(client, range(clients)))
+    seconds = time.perf_counter() - start
+    latencies = np.concatenate([result[0] for result in results])
+    return {'clients': clients, 'requests': len(latencies), 'errors': sum(result[1] for result in results),
+            'seconds': seconds, 'requests_per_second': len(latencies) / seconds,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000), 'p95_ms': float(np.percentile(latencies, 95) * 1000)}
+
+
+def benchmark_service(data_path:str, clients:list=DEFAULT_CLIENTS, requests:int=200, queries:list=SERVICE_QUERIES) -> list:
+    """ Requests per second and latencies of the query service (service.py) with concurrent clients.
+        The service runs in its own process, as it would for the teams querying it; its loading time is not counted.
+    """
+    port = _free_port()
+    server = subprocess.Popen([sys.executable, 'service.py', data_path, '--port', str(port)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        # The service prints its address once the data is loaded
+        server.stdout.readline()
+        if server.poll() is not None:
+            raise RuntimeError(f"The query service stopped with status {server.returncode}")
+        return [_run_clients(port, n_clients, requests, queries) for n_clients in clients]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare_results(old:dict, new:dict) -> pd.DataFrame:
+    """ Seconds of each (rows, stage) in two benchmark runs, and the speedup of the new one"""
+    old_df = pd.DataFrame(old['results']).set_index(['rows', 'stage'])['seconds']
+    new_df = pd.DataFrame(new['results']).set_index(['rows', 'stage'])['seconds']
+    comparison = pd.DataFrame({old['commit'] or 'old': old_df, new['commit'] or 'new': new_df}).dropna()
+    comparison['speedup'] = old_df / new_df
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the cleaning pipeline on synthetic dirty AED exports")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="numbers of rows of the synthetic datasets (e.g. 10000 1000000 10000000)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true', help="also measure the peak memory of each stage (slower)")
+    parser.add_argument('--output', help="JSON file the results are written to")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    parser.add_argument('--startup', action='store_true', help="only measure the startup time of the command line")
+    parser.add_argument('--service', action='store_true',
+                        help="only measure the query service under concurrent clients, on the first size")
+    parser.add_argument('--clients', type=int, nargs='+', default=DEFAULT_CLIENTS,
+                        help="numbers of concurrent clients of the service benchmark")
+    args = parser.parse_args()
+
+    if args.startup:
+        print(json.dumps(benchmark_startup(), indent=2))
+        raise SystemExit
+    if args.service:
+        print(pd.DataFrame(benchmark_service(dataset_path(args.sizes[0], args.seed), args.clients)).to_string(index=False))
+        raise SystemExit
+
+    results = run_benchmark(args.sizes, args.seed, args.memory)
+    print(pd.DataFrame(results['results']).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_results(json.load(f), results).to_string())
@@ -0,0 +1,39 @@
+import pandas as pd
+
+
+def test_generate_dirty_data(tmp_path):
+    from benchmark import generate_dirty_data
+    from loader import frame_data, load_clean_data, load_formatted_data, sanitize_data
+    path = generate_dirty_data(500, tmp_path / 'dirty.csv', seed=1, chunksize=200)
+    raw = pd.read_csv(path, dtype=str, keep_default_na=False)
+    assert len(raw) == 500
+    # The defects handled by the loader are all there
+    assert raw['adr_num'].str.contains(r'^\d+ - ?\d+$').any()
+    assert raw['adr_voie'].str.contains(r'\b\d{5}\b').any()
+    assert raw['tel1'].str.startswith('334').any()
+    assert (raw['freq_mnt'] == 'Tout les ans').any()
+    assert raw['freq_mnt'].str.match(r'\d{4}-\d{2}-\d{2}').any()
+    # Same file for the same seed
+    same = generate_dirty_data(500, tmp_path / 'again.csv', seed=1, chunksize=200)
+    assert open(same).read() == open(path).read()
+
+    reference = frame_data(sanitize_data(load_formatted_data(path), engine='loop'))
+    pd.testing.assert_frame_equal(load_clean_data(path), reference)
+
+
+def test_run_benchmark(tmp_path, monkeypatch):
+    import benchmark
+    monkeypatch.setattr(benchmark, 'BENCHMARK_DIR', str(tmp_path))
+    results = benchmark.run_benchmark([100], memory=True)
+    assert [result['stage'] for result in results['results']] == [
+        'load_formatted_data', 'sanitize_data', 'frame_data', 'load_clean_data']
+    assert all(result['rows'] == 100 and result['peak_bytes'] > 0 for result in results['results'])
+    comparison = benchmark.compare_results(results, results)
+    assert (comparison['speedup'] == 1).all()
+
+
+def test_benchmark_service():
+    from benchmark import benchmark_service
+    results = benchmark_service('data/sample_dirty.csv', clients=[1, 3], requests=10)
+    assert [(result['clients'], result['requests'], result['errors']) for result in results] == [(1, 10, 0), (3, 30, 0)]
+    assert all(result['requests_per_second'] > 0 and result['p95_ms'] >= result['p50_ms'] for result in results)
@@ -0,0 +1,163 @@
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from spatial import COORDINATES_SWAPPED, EARTH_RADIUS, haversine
+
+# Two defibrillators are the same one listed twice when their names are similar and they are at most
+# DUPLICATE_DISTANCE km apart, or, when the position of one of them is unknown, their addresses are similar too.
+# Similarities are Jaccard similarities of character trigrams: typos and spacing do not matter much, while the devices
+# of a same building ('... Piscine' and '... Gymnase', '... (commerce)' and '... (atelier)') stay below the threshold.
+# Texts with different numbers ('bâtiment1' and 'bâtiment2', '104 rue ...' and '220 rue ...') are never similar.
+DUPLICATE_DISTANCE = 0.1
+NAME_SIMILARITY = 0.85
+ADDRESS_SIMILARITY = 0.7
+
+# Name words of at least this length are blocking keys within a postal code, unless more than MAX_BLOCK_SIZE rows
+# share them (common words like 'ecole' or 'gymnase' would bring back the pairwise comparison).
+# The same goes for the cells of the coordinate grid: many rows at the same position (a default position, the centre
+# of a town) are only compared through their postal code and name words.
+MIN_TOKEN_LENGTH = 3
+MAX_BLOCK_SIZE = 100
+
+POSTAL_CODE = re.compile(r'\b(\d{5})\b')
+NOT_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+NUMBERS = re.compile(r'\d+')
+
+
+def normalize_name(name:str) -> str:
+    """ Lower case words without accents nor punctuation"""
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return NOT_ALPHANUMERIC.sub(' ', name).strip()
+
+
+def _trigrams(text:str) -> frozenset:
+    padded = f' {text} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class _Texts:
+    """ Normalized texts of a column, with their trigrams and numbers, computed once per distinct value"""
+
+    def __init__(self, s:pd.Series):
+        # Code of each row, -1 for null values
+        self.codes, uniques = pd.factorize(s)
+        self.normalized = [normalize_name(value) for value in uniques]
+        self.trigrams = [_trigrams(value) for value in self.normalized]
+        self.numbers = [frozenset(NUMBERS.findall(value)) for value in self.normalized]
+
+    def similarity(self, first:np.ndarray, second:np.ndarray) -> np.ndarray:
+        """ Similarity of the texts of the rows of each pair, 0 when one of them is null or their numbers differ"""
+        similarity = np.zeros(len(first))
+        for k, (i, j) in enumerate(zip(self.codes[first], self.codes[second])):
+            if i == j:
+                similarity[k] = i >= 0
+            elif i >= 0 and j >= 0 and not (self.numbers[i] and self.numbers[j] and self.numbers[i] != self.numbers[j]):
+                a, b = self.trigrams[i], self.trigrams[j]
+                similarity[k] = len(a & b) / len(a | b)
+        return similarity
+
+
+def _block_pairs(keys:pd.DataFrame, other_keys:pd.DataFrame=None) -> np.ndarray:
+    """ Pairs of rows sharing a blocking key (the 'row' column holds the positions of the rows):
+        within keys, or between keys and other_keys
+    """
+    on = [column for column in keys.columns if column != 'row']
+    pairs = keys.merge(keys if other_keys is None else other_keys, on=on)[['row_x', 'row_y']].to_numpy()
+    if other_keys is None:
+        pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+    return np.sort(pairs, axis=1)
+
+
+def _coordinate_pairs(latitudes:np.ndarray, longitudes:np.ndarray, distance:float) -> np.ndarray:
+    """ Pairs of rows in the same cell, or in neighbour cells, of a grid whose cells are at least distance km wide.
+        The rows of cells holding more than MAX_BLOCK_SIZE rows are left out.
+    """
+    known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+    if not known.any():
+        return np.empty((0, 2), dtype=np.int64)
+    lat_cell = np.degrees(distance / EARTH_RADIUS)
+    # Degrees of longitude are shorter away from the equator
+    lon_cell = lat_cell / np.cos(np.radians(min(np.abs(latitudes[known]).max(), 89)))
+    cells = pd.DataFrame({'row': np.flatnonzero(known),
+                          'y': np.floor(latitudes[known] / lat_cell).astype(np.int64),
+                          'x': np.floor(longitudes[known] / lon_cell).astype(np.int64)})
+    cells = cells[cells.groupby(['y', 'x'])['row'].transform('size') <= MAX_BLOCK_SIZE]
+    pairs = [_block_pairs(cells)]
+    # Each pair of neighbour cells once
+    for dy, dx in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        pairs.append(_block_pairs(cells, cells.assign(y=cells['y'] - dy, x=cells['x'] - dx)))
+    return np.concatenate(pairs)
+
+
+def _postal_code_pairs(addresses:pd.Series, names:_Texts) -> np.ndarray:
+    """ Pairs of rows with the same postal code sharing a name word which is not too common there"""
+    postal_codes = addresses.str.extract(POSTAL_CODE, expand=False).to_numpy(dtype=object)
+    words = [value.split() for value in names.normalized]
+    tokens = pd.DataFrame({'row': np.arange(len(addresses)), 'postal_code': postal_codes,
+                           'token': [words[code] if code >= 0 else [] for code in names.codes]})
+    tokens = tokens.dropna(subset=['postal_code']).explode('token').dropna(subset=['token'])
+    tokens = tokens[tokens['token'].str.len() >= MIN_TOKEN_LENGTH].drop_duplicates()
+    block_sizes = tokens.groupby(['postal_code', 'token'])['row'].transform('size')
+    return _block_pairs(tokens[block_sizes <= MAX_BLOCK_SIZE])
+
+
+def duplicate_pairs(df:pd.DataFrame, swapped:bool=COORDINATES_SWAPPED, distance:float=DUPLICATE_DISTANCE,
+                    name_similarity:float=NAME_SIMILARITY, address_similarity:float=ADDRESS_SIMILARITY) -> np.ndarray:
+    """ Positions of the pairs of rows of a clean dataframe (as returned by load_clean_data) which are duplicates.
+        Only the pairs of rows sharing a block are compared: close positions, or a postal code and a name word.
+        swapped: the 'Latitude' column holds longitudes and the 'Longitude' column latitudes, as in the raw export.
+    """
+    lat_column, lon_column = ('Longitude', 'Latitude') if swapped else ('Latitude', 'Longitude')
+    latitudes = df[lat_column].to_numpy(dtype=float)
+    longitudes = df[lon_column].to_numpy(dtype=float)
+    names = _Texts(df['Name'])
+
+    pairs = np.concatenate([_coordinate_pairs(latitudes, longitudes, distance),
+                            _postal_code_pairs(df['Address'].astype('string'), names)])
+    if len(pairs) == 0:
+        return pairs
+    pairs = np.unique(pairs, axis=0)
+    first, second = pairs[:, 0], pairs[:, 1]
+
+    # Positions first, they are compared for all the pairs at once
+    distances = haversine(latitudes[first], longitudes[first], latitudes[second], longitudes[second])
+    close = distances <= distance
+    unknown = np.isnan(distances)
+    keep = close | unknown
+    first, second, unknown = first[keep], second[keep], unknown[keep]
+
+    similar = names.similarity(first, second) >= name_similarity
+    if unknown.any():
+        check = similar & unknown
+        similar[check] = _Texts(df['Address']).similarity(first[check], second[check]) >= address_similarity
+    return np.column_stack([first[similar], second[similar]])
+
+
+def duplicate_clusters(df:pd.DataFrame, **kwargs) -> pd.Series:
+    """ Cluster id of each row of a clean dataframe: the rows of a cluster are the same defibrillator.
+        Ids are numbered in the order of the first row of each cluster, a row without duplicate has its own id.
+        The keyword arguments are passed to duplicate_pairs.
+    """
+    parents = np.arange(len(df))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in duplicate_pairs(df, **kwargs):
+        i, j = root(i), root(j)
+        if i != j:
+            parents[max(i, j)] = min(i, j)
+    roots = np.array([root(i) for i in range(len(df))], dtype=np.int64)
+    # Roots are the first row of their cluster: number them in order
+    return pd.Series(np.unique(roots, return_inverse=True)[1], index=df.index, name='Cluster')
+
+
+def drop_duplicates(df:pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """ First row of each cluster of duplicates"""
+    return df[~duplicate_clusters(df, **kwargs).duplicated().to_numpy()]
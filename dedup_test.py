@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+
+def test_duplicate_clusters_on_raw_data():
+    from dedup import duplicate_clusters
+    from loader import DATA_PATH, load_clean_data
+    clean_data = load_clean_data(DATA_PATH)
+    clusters = duplicate_clusters(clean_data)
+    assert len(clusters) == len(clean_data) and clusters.index.equals(clean_data.index)
+    # The zoo is listed several times, the devices of the pavilions around place Zeus are different ones
+    assert clusters[clean_data['Name'] == 'Zoo de Lunaret'].nunique() == 1
+    pavilions = clean_data['Name'].str.contains('PAVILLON', na=False)
+    assert clusters[pavilions].nunique() == pavilions.sum() > 1
+
+
+def test_duplicate_clusters():
+    from dedup import drop_duplicates, duplicate_clusters
+    # Latitude and Longitude are swapped, as in the Montpellier export
+    df = pd.DataFrame({
+        'Name': ['Médiathèque William Shakespeare', 'MEDIATHEQUE William SHAKESPEAR', 'Mediatheque William Shakespeare',
+                 'Gymnase Bessière', 'Gymnase Bessiere', 'Université UFR Droit (bâtiment1)',
+                 'Université UFR Droit (bâtiment2)', 'Gymnase Bessière', None],
+        'Address': ['150 avenue Paul Bringuier 34080 Montpellier', '150 av. Paul Bringuier 34080 Montpellier',
+                    '150 avenue Paul Bringuier 34080 Montpellier', '175 rue Edouard-Villalonga 34000 Montpellier',
+                    '175 rue Edouard Villalonga 34000 Montpellier', '39 rue de l\'Université 34000 Montpellier',
+                    '39 rue de l\'Université 34000 Montpellier', '12 rue de la Loge 34000 Montpellier', None],
+        'Latitude': [3.8440, 3.8441, np.nan, 3.8800, 3.8801, 3.8760, 3.8760, 3.9000, 3.8440],
+        'Longitude': [43.6130, 43.6131, np.nan, 43.6000, 43.6001, 43.6110, 43.6110, 43.6200, 43.6130],
+    }, index=range(10, 19))
+    clusters = duplicate_clusters(df)
+    # Typos and spacing, a row without position found by its postal code and address
+    assert (clusters.loc[[10, 11, 12]] == 0).all()
+    assert clusters.loc[13] == clusters.loc[14]
+    # Different numbers, the same name 2 km away, no name
+    assert clusters.loc[[13, 15, 16, 17, 18]].nunique() == 5
+    assert clusters.tolist() == [0, 0, 0, 1, 1, 2, 3, 4, 5]
+    assert drop_duplicates(df).index.tolist() == [10, 13, 15, 16, 17, 18]
+
+
+def test_duplicate_clusters_crowded_position():
+    from dedup import MAX_BLOCK_SIZE, _coordinate_pairs, duplicate_clusters
+    # Every row at the same default position: the position is not a block, the postal code and the name words are
+    n_rows = 3 * MAX_BLOCK_SIZE
+    names = ['Pharmacie de la Comédie'] + [f'Pharmacie {i}' for i in range(1, n_rows - 1)] + ['Pharmacie de la Comedie']
+    df = pd.DataFrame({'Name': names, 'Address': ['1 place de la Comédie 34000 Montpellier'] * n_rows,
+                       'Latitude': 3.8767, 'Longitude': 43.6109})
+    assert len(_coordinate_pairs(df['Longitude'].to_numpy(), df['Latitude'].to_numpy(), 0.1)) == 0
+    clusters = duplicate_clusters(df)
+    assert clusters.nunique() == n_rows - 1 and clusters.iloc[0] == clusters.iloc[-1]
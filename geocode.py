@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import loader
+from dedup import normalize_name
+from spatial import COORDINATES_SWAPPED
+
+# Local geocoding of the rows without coordinates, from an address file in the format of the Base Adresse Nationale
+# (adresses-<department>.csv from adresse.data.gouv.fr: one row per address, ';' separated, WGS84 lon/lat).
+# Its addresses are indexed by the hash of their normalized street and area (postal code, INSEE code or commune name),
+# with and without the house number: the house number gives the position of the address, the street alone the mean
+# position of its addresses. Index files are written once per address file, in GEOCODE_DIR.
+GEOCODE_DIR = 'data/.cache/geocode'
+GEOCODING_VERSION = 1
+ADDRESS_SEPARATOR = ';'
+ADDRESS_COLUMNS = ['numero', 'nom_voie', 'code_postal', 'code_insee', 'nom_commune', 'lon', 'lat']
+ADDRESS_CHUNKSIZE = 500_000
+
+# Street names are compared without accents, punctuation, articles nor abbreviations
+STREET_ABBREVIATIONS = {'av': 'avenue', 'ave': 'avenue', 'bd': 'boulevard', 'bld': 'boulevard', 'bvd': 'boulevard',
+                        'pl': 'place', 'imp': 'impasse', 'all': 'allee', 'ch': 'chemin', 'che': 'chemin', 'rte': 'route',
+                        'r': 'rue', 'st': 'saint', 'ste': 'sainte', 'dr': 'docteur', 'pr': 'professeur',
+                        'prof': 'professeur', 'gal': 'general', 'gen': 'general', 'mal': 'marechal', 'sq': 'square'}
+STOP_WORDS = frozenset(['de', 'du', 'des', 'la', 'le', 'les', 'l', 'd', 'et'])
+# Words following a house number which are part of it ('3 bis', '12-14' normalized to '12 14')
+NUMBER_SUFFIXES = re.compile(r'^(bis|ter|quater|[a-d]|\d+)$')
+AREA_CODE = re.compile(r'\b\d{5}\b')
+
+# Precision of the backfilled positions
+ADDRESS_PRECISION = 'address'
+STREET_PRECISION = 'street'
+
+
+def normalize_street(street:str) -> str:
+    """ Lower case street name without accents, punctuation, articles nor abbreviations"""
+    words = (STREET_ABBREVIATIONS.get(word, word) for word in normalize_name(street).split())
+    return ' '.join(word for word in words if word not in STOP_WORDS)
+
+
+def _on_unique(s:pd.Series, function) -> np.ndarray:
+    """ function applied once per distinct value of s, None for null values"""
+    codes, uniques = pd.factorize(s)
+    results = np.empty(len(uniques) + 1, dtype=object)
+    results[:-1] = [function(value) for value in uniques]
+    return results[codes]
+
+
+def _hash_keys(*parts) -> np.ndarray:
+    """ 64 bits hash of each row of '|' joined string arrays"""
+    keys = parts[0].astype(object)
+    for part in parts[1:]:
+        keys = keys + '|' + part.astype(object)
+    return pd.util.hash_array(keys.astype(object))
+
+
+def _parse_address(normalized:str, communes:frozenset) -> tuple:
+    """ House number, normalized street and areas (5 digits codes, then commune name) of a normalized address"""
+    # frame_data puts the postal code after the street, which may have numbers of 5 digits too: the last code first
+    codes = list(AREA_CODE.finditer(normalized))[::-1]
+    words = normalized.split()
+    # The commune name is the longest trailing words which are a commune of the index
+    commune = next((i for i in range(1, len(words)) if ' '.join(words[i:]) in communes), None)
+    areas = [code.group() for code in codes] + ([' '.join(words[commune:])] if commune is not None else [])
+    if codes:
+        words = normalized[:codes[0].start()].split()
+    elif commune is not None:
+        words = words[:commune]
+
+    number = None
+    if words and words[0].isdigit():
+        number = str(int(words[0]))
+        words = words[1:]
+        while words and NUMBER_SUFFIXES.match(words[0]):
+            words = words[1:]
+    street = normalize_street(' '.join(words))
+    return number, street or None, areas
+
+
+class AddressIndex:
+    """ Positions of the addresses of an address file, looked up by the 64 bits hashes of their normalized street and
+        area, with or without the house number. Keys are sorted so that many addresses are looked up at once
+        (np.searchsorted) rather than one at a time.
+    """
+
+    def __init__(self, address_keys, address_positions, street_keys, street_positions, communes):
+        self.address_keys = np.asarray(address_keys, dtype=np.uint64)
+        self.address_positions = np.asarray(address_positions, dtype=float)
+        self.street_keys = np.asarray(street_keys, dtype=np.uint64)
+        self.street_positions = np.asarray(street_positions, dtype=float)
+        self.communes = frozenset(communes)
+
+    @classmethod
+    def from_csv(cls, path:str, sep:str=ADDRESS_SEPARATOR, chunksize:int=ADDRESS_CHUNKSIZE):
+        """ Index an address file, read by chunks"""
+        address_parts, street_parts, communes = [], [], set()
+        for chunk in pd.read_csv(path, sep=sep, usecols=ADDRESS_COLUMNS, dtype=str, encoding='utf-8', chunksize=chunksize):
+            chunk = chunk.dropna(subset=['nom_voie', 'lon', 'lat'])
+            positions = chunk[['lat', 'lon']].astype(float).to_numpy()
+            streets = _on_unique(chunk['nom_voie'], normalize_street)
+            numbers = chunk['numero'].fillna('').str.lstrip('0').to_numpy(dtype=object)
+            commune_names = pd.Series(_on_unique(chunk['nom_commune'].fillna(''), normalize_name))
+            communes.update(commune_names.unique())
+            # Every address can be found by its postal code, its INSEE code and its commune name
+            for areas in (chunk['code_postal'], chunk['code_insee'], commune_names):
+                areas = areas.fillna('').to_numpy(dtype=object)
+                known = (areas != '') & (streets != '')
+                street_parts.append(pd.DataFrame({'key': _hash_keys(streets[known], areas[known]),
+                                                  'lat': positions[known, 0], 'lon': positions[known, 1]}))
+                numbered = known & (numbers != '')
+                address_parts.append(pd.DataFrame({'key': _hash_keys(streets[numbered], areas[numbered], numbers[numbered]),
+                                                   'lat': positions[numbered, 0], 'lon': positions[numbered, 1]}))
+
+        def mean_positions(parts):
+            # Same address several times (with 'bis' and 'ter', or both codes the same): their mean position
+            means = pd.concat(parts).groupby('key', sort=True)[['lat', 'lon']].mean()
+            return means.index.to_numpy(dtype=np.uint64), means.to_numpy()
+
+        communes.discard('')
+        return cls(*mean_positions(address_parts), *mean_positions(street_parts), sorted(communes))
+
+    def save(self, path:str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Write then rename, so that a reader never sees a partial index
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, address_keys=self.address_keys, address_positions=self.address_positions,
+                     street_keys=self.street_keys, street_positions=self.street_positions,
+                     communes=np.array(sorted(self.communes), dtype=str))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path:str):
+        with np.load(path) as arrays:
+            return cls(arrays['address_keys'], arrays['address_positions'], arrays['street_keys'],
+                       arrays['street_positions'], arrays['communes'].tolist())
+
+    def __len__(self):
+        return len(self.address_keys)
+
+    @staticmethod
+    def _find(sorted_keys:np.ndarray, keys:np.ndarray) -> np.ndarray:
+        """ Position of each key in sorted_keys, -1 when it is not there"""
+        positions = np.searchsorted(sorted_keys, keys).clip(max=max(len(sorted_keys) - 1, 0))
+        found = (sorted_keys[positions] == keys) if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def lookup(self, addresses:pd.Series) -> pd.DataFrame:
+        """ Latitude, longitude and precision (ADDRESS_PRECISION or STREET_PRECISION) of addresses as merged by
+            frame_data ('<number> <street> <postal code> <commune>'), NaN and None when they are not found.
+            The addresses are parsed once per distinct value, their keys are then looked up all at once.
+        """
+        codes, uniques = pd.factorize(addresses)
+        parsed = [_parse_address(normalize_name(address), self.communes) for address in uniques]
+        numbers = np.array([number or '' for number, _, _ in parsed], dtype=object)
+        streets = np.array([street or '' for _, street, _ in parsed], dtype=object)
+        areas = [areas if street else [] for _, street, areas in parsed]
+
+        positions = np.full((len(uniques), 2), np.nan)
+        precisions = np.full(len(uniques), None, dtype=object)
+        # The house number first, then the street alone; each time the areas in the order of the address
+        for precision, keys, key_positions in [(ADDRESS_PRECISION, self.address_keys, self.address_positions),
+                                               (STREET_PRECISION, self.street_keys, self.street_positions)]:
+            for rank in range(max(map(len, areas), default=0)):
+                todo = np.flatnonzero(np.array([len(row_areas) > rank for row_areas in areas], dtype=bool)
+                                      & (precisions == None))  # noqa: E711 (element-wise comparison)
+                if precision == ADDRESS_PRECISION:
+                    todo = todo[numbers[todo] != '']
+                if len(todo) == 0:
+                    continue
+                row_areas = np.array([areas[i][rank] for i in todo], dtype=object)
+                parts = (streets[todo], row_areas) + ((numbers[todo],) if precision == ADDRESS_PRECISION else ())
+                found = self._find(keys, _hash_keys(*parts))
+                hits = found >= 0
+                positions[todo[hits]] = key_positions[found[hits]]
+                precisions[todo[hits]] = precision
+
+        # Null addresses (code -1) take the row of not found values appended at the end
+        positions = np.vstack([positions, [np.nan, np.nan]])[codes]
+        precisions = np.append(precisions, None)[codes]
+        return pd.DataFrame({'lat': positions[:, 0], 'lon': positions[:, 1], 'precision': precisions}, index=addresses.index)
+
+
+def load_address_index(address_path:str, index_dir:str=GEOCODE_DIR) -> AddressIndex:
+    """ Index of an address file, built on first use and saved in index_dir.
+        The index is identified by the path, size and modification time of the address file (as project_raw_data).
+    """
+    stat = os.stat(address_path)
+    path_key = hashlib.sha256(os.path.abspath(address_path).encode()).hexdigest()[:16]
+    version_key = hashlib.sha256(f'{stat.st_size}:{stat.st_mtime_ns}:{GEOCODING_VERSION}'.encode()).hexdigest()[:16]
+    index_path = os.path.join(index_dir, f'{path_key}-{version_key}.npz')
+    if os.path.exists(index_path):
+        return AddressIndex.load(index_path)
+
+    index = AddressIndex.from_csv(address_path)
+    index.save(index_path)
+    # Indexes of previous versions of the address file are not needed anymore
+    for name in os.listdir(index_dir):
+        if name.startswith(path_key) and name.endswith('.npz') and name != os.path.basename(index_path):
+            os.remove(os.path.join(index_dir, name))
+    return index
+
+
+def backfill_coordinates(df:pd.DataFrame, index:AddressIndex, swapped:bool=COORDINATES_SWAPPED,
+                         stats:dict=None) -> pd.DataFrame:
+    """ Copy of a clean dataframe whose rows without Latitude or Longitude get the position of their Address.
+        Rows with both coordinates are left as they are; a row with a single one gets both.
+        swapped: the 'Latitude' column holds longitudes and the 'Longitude' column latitudes, as in the raw export.
+        stats: dict filled with the number of rows missing a coordinate, and of those found at their house number
+               ('address'), at the mean position of their street ('street') or not found ('not_found').
+    """
+    lat_column, lon_column = ('Longitude', 'Latitude') if swapped else ('Latitude', 'Longitude')
+    missing = (df[lat_column].isna() | df[lon_column].isna()).to_numpy()
+    found = index.lookup(df['Address'][missing])
+    hits = found['precision'].notna().to_numpy()
+
+    df = df.copy(deep=False)
+    rows = np.flatnonzero(missing)[hits]
+    for column, values in [(lat_column, found['lat']), (lon_column, found['lon'])]:
+        # Same dtype as before, the coordinates of a compact frame are float32
+        filled = df[column].to_numpy(dtype=float, na_value=np.nan)
+        filled[rows] = values.to_numpy()[hits]
+        df[column] = pd.Series(filled, index=df.index, name=column).astype(df[column].dtype)
+
+    if stats is not None:
+        counts = found['precision'].value_counts()
+        stats.update({'missing': int(missing.sum()), ADDRESS_PRECISION: int(counts.get(ADDRESS_PRECISION, 0)),
+                      STREET_PRECISION: int(counts.get(STREET_PRECISION, 0)), 'not_found': int((~hits).sum())})
+    return df
+
+
+def main(argv:list=None) -> int:
+    """ Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(description="Fill the missing coordinates of the clean AED data from a local "
+                                                 "address file (Base Adresse Nationale csv)")
+    parser.add_argument('addresses', help="address file, e.g. adresses-34.csv from adresse.data.gouv.fr")
+    parser.add_argument('-i', '--input', default=loader.DATA_PATH, help="raw csv, or clean Parquet/Arrow file")
+    parser.add_argument('-o', '--output', default='data/geocoded.csv', help="clean file written (csv, Parquet or Arrow)")
+    args = parser.parse_args(argv)
+
+    stats = {}
+    df = backfill_coordinates(loader.load_clean_data(args.input), load_address_index(args.addresses), stats=stats)
+    loader.save_clean_data(df, args.output)
+    print(f"{stats['missing']} rows without coordinates: {stats[ADDRESS_PRECISION]} found at their house number, "
+          f"{stats[STREET_PRECISION]} at their street, {stats['not_found']} not found")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
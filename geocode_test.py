@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+# A few addresses in the format of the Base Adresse Nationale files
+ADDRESSES = """id;id_fantoir;numero;rep;nom_voie;code_postal;code_insee;nom_commune;code_insee_ancienne_commune;nom_ancienne_commune;x;y;lon;lat;type_position;alias;nom_ld;libelle_acheminement;nom_afnor;source_position;source_nom_voie;certification_commune;cad_parcelles
+34172_1210_00155;34172_1210;155;;Rue de Bologne;34080;34172;Montpellier;;;0;0;3.8462;43.6083;entrée;;;MONTPELLIER;RUE DE BOLOGNE;commune;commune;1;
+34172_1210_00157;34172_1210;157;;Rue de Bologne;34080;34172;Montpellier;;;0;0;3.8464;43.6085;entrée;;;MONTPELLIER;RUE DE BOLOGNE;commune;commune;1;
+34172_2290_00655;34172_2290;655;;Avenue du Maréchal Leclerc;34070;34172;Montpellier;;;0;0;3.8780;43.5960;entrée;;;MONTPELLIER;AV DU MARECHAL LECLERC;commune;commune;1;
+34172_2290_00657;34172_2290;657;;Avenue du Maréchal Leclerc;34070;34172;Montpellier;;;0;0;3.8790;43.5970;entrée;;;MONTPELLIER;AV DU MARECHAL LECLERC;commune;commune;1;
+34172_3380_00003;34172_3380;3;;Rue Fabre;34000;34172;Montpellier;;;0;0;3.8800;43.6100;entrée;;;MONTPELLIER;RUE FABRE;commune;commune;1;
+34172_3380_00003_bis;34172_3380;3;bis;Rue Fabre;34000;34172;Montpellier;;;0;0;3.8802;43.6102;entrée;;;MONTPELLIER;RUE FABRE;commune;commune;1;
+34172_4470_00010;34172_4470;10;;Rue Georges Brassens;34000;34172;Montpellier;;;0;0;3.8600;43.6200;entrée;;;MONTPELLIER;RUE GEORGES BRASSENS;commune;commune;1;
+34172_4470_00030;34172_4470;30;;Rue Georges Brassens;34000;34172;Montpellier;;;0;0;3.8620;43.6220;entrée;;;MONTPELLIER;RUE GEORGES BRASSENS;commune;commune;1;
+34129_0010_00001;34129_0010;1;;Rue Georges Brassens;34970;34129;Lattes;;;0;0;3.9000;43.5700;entrée;;;LATTES;RUE GEORGES BRASSENS;commune;commune;1;
+"""
+
+
+@pytest.fixture
+def address_fname(tmp_path) -> str:
+    path = tmp_path / 'adresses-34.csv'
+    path.write_text(ADDRESSES, encoding='utf-8')
+    return str(path)
+
+
+def test_address_index(address_fname, tmp_path):
+    from geocode import ADDRESS_PRECISION, STREET_PRECISION, AddressIndex, load_address_index
+    index = load_address_index(address_fname, tmp_path / 'index')
+    addresses = pd.Series(['155 Rue de Bologne 34080 Montpellier',
+                           # INSEE code instead of the postal code
+                           '155 rue de Bologne 34172 Montpellier',
+                           # Abbreviation and accents, 3 bis found at the mean position of 3 and 3 bis
+                           '655 av. Maréchal Leclerc 34070 Montpellier', '3 bis rue Fabre 34000',
+                           # Unknown number, no number, commune without postal code, street of another commune
+                           '999 rue Fabre 34000 Montpellier', 'Rue Georges Brassens Montpellier',
+                           'rue georges brassens Lattes', 'rue Fabre 34970', None, 'Montpellier'],
+                          index=range(10, 20))
+    found = index.lookup(addresses)
+    assert found.index.equals(addresses.index)
+    assert found['precision'].tolist() == [ADDRESS_PRECISION] * 4 + [STREET_PRECISION] * 3 + [None] * 3
+    assert found.loc[10, ['lat', 'lon']].tolist() == found.loc[11, ['lat', 'lon']].tolist() == [43.6083, 3.8462]
+    assert found.loc[13, ['lat', 'lon']].tolist() == pytest.approx([43.6101, 3.8801])
+    assert found.loc[14, ['lat', 'lon']].tolist() == pytest.approx([43.6101, 3.8801])
+    assert found.loc[15, ['lat', 'lon']].tolist() == pytest.approx([43.621, 3.861])
+    assert found.loc[16, ['lat', 'lon']].tolist() == [43.57, 3.9]
+    assert found.loc[17:, 'lat'].isna().all()
+
+    # The index is built once, then read back
+    assert len(list((tmp_path / 'index').iterdir())) == 1
+    again = load_address_index(address_fname, tmp_path / 'index')
+    assert isinstance(again, AddressIndex) and again.communes == index.communes == {'montpellier', 'lattes'}
+    pd.testing.assert_frame_equal(again.lookup(addresses), found)
+
+
+def test_backfill_coordinates(address_fname, tmp_path):
+    from geocode import AddressIndex, backfill_coordinates
+    from loader import compact_clean_data
+    index = AddressIndex.from_csv(address_fname)
+    # Latitude and Longitude are swapped, as in the Montpellier export
+    df = pd.DataFrame({'Name': ['a', 'b', 'c', 'd', 'e'],
+                       'Address': pd.array(['155 Rue de Bologne 34080 Montpellier', '3 rue Fabre 34000',
+                                            '157 Rue de Bologne 34080 Montpellier', 'rue Inconnue 34000', None],
+                                           dtype='string'),
+                       'Latitude': [np.nan, 3.88, 3.5, np.nan, np.nan],
+                       'Longitude': [np.nan, np.nan, 43.5, np.nan, np.nan]})
+    stats = {}
+    backfilled = backfill_coordinates(df, index, stats=stats)
+    assert stats == {'missing': 4, 'address': 2, 'street': 0, 'not_found': 2}
+    # A row with a single coordinate gets both
+    assert backfilled['Latitude'].tolist()[:3] == pytest.approx([3.8462, 3.8801, 3.5])
+    assert backfilled['Longitude'].tolist()[:3] == pytest.approx([43.6083, 43.6101, 43.5])
+    assert backfilled.loc[3:, ['Latitude', 'Longitude']].isna().all().all()
+    # The frame itself is left as it is
+    assert df['Latitude'].isna().sum() == 3
+
+    compact = backfill_coordinates(compact_clean_data(df), index, swapped=False)
+    assert compact['Latitude'].dtype == compact_clean_data(df)['Latitude'].dtype
+    assert compact.loc[0, ['Latitude', 'Longitude']].tolist() == pytest.approx([43.6083, 3.8462])
@@ -1,62 +1,531 @@
+from __future__ import annotations
+
+import codecs
+import contextlib
+import csv
+import hashlib
+import importlib.util
+import json
 import os
 import re
-import requests
-import numpy as np
-import pandas as pd
+import sys
+import time
+import tracemalloc
+
+
+def _lazy_import(name:str):
+    """ Module executed on first attribute access: importing loader does not pay for pandas and numpy,
+        so that command line runs which find their outputs up to date start fast (see IMPORT_TIME_BUDGET).
+        The first access is not thread-safe before Python 3.12: requests, used from the download threads of fetch_all,
+        and pyarrow are rather imported by the functions needing them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = _lazy_import('numpy')
+pd = _lazy_import('pandas')
+
+# Seconds `import loader` should take (reported by benchmark.py): only the standard library is actually imported
+IMPORT_TIME_BUDGET = 0.1
 
 DATA_PATH = 'data/MMM_MMM_DAE.csv'
 
-def download_data(url = DATA_PATH, force_download=False):
-    # Utility function to donwload data if it is not in disk
+# Size of the blocks streamed from the network to the disk
+DOWNLOAD_BLOCK_SIZE = 2**16
+
+
+def _declared_encoding(content_type:str):
+    """ Charset declared in a Content-Type header, if any"""
+    match = re.search(r'charset=["\']?([\w.:-]+)', content_type or '', flags=re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def _read_download_meta(meta_path:str) -> dict:
+    """ Validators (ETag, Last-Modified) and encoding of the previous download of a file"""
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_download_meta(meta_path:str, meta:dict) -> None:
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def _finalize_download(part_path:str, data_path:str, encoding:str) -> None:
+    """ Move a complete download to its final path, re-encoded in utf-8 (the encoding read by load_formatted_data)"""
+    if codecs.lookup(encoding).name in ('utf-8', 'utf-8-sig'):
+        os.replace(part_path, data_path)
+        return
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(part_path, 'rb') as source, open(data_path + '.tmp', 'w', encoding='utf-8', newline='') as target:
+        for block in iter(lambda: source.read(DOWNLOAD_BLOCK_SIZE), b''):
+            target.write(decoder.decode(block))
+        target.write(decoder.decode(b'', final=True))
+    os.replace(data_path + '.tmp', data_path)
+    os.remove(part_path)
+
+
+def download_data(url = DATA_PATH, force_download=False, encoding:str=None, timeout:float=60):
+    """ Utility function to download data if it is not in disk.
+        The file is streamed to disk: an interrupted download is resumed with an HTTP Range request,
+        and with force_download an unchanged file (same ETag/Last-Modified) is not downloaded again.
+        encoding: encoding of the remote file, by default the charset declared by the server, or utf-8.
+    """
     data_path = os.path.join('data', os.path.basename(url.split('?')[0]))
-    if not os.path.exists(data_path) or force_download:
-        # ensure data dir is created
-        os.makedirs('data', exist_ok=True)
-        # request data from url
-        response = requests.get(url, allow_redirects=True)
-        # save file
-        with open(data_path, "w") as f:
-            # Note the content of the response is in binary form: 
-            # it needs to be decoded.
-            # The response object also contains info about the encoding format
-            # which we use as argument for the decoding
-            f.write(response.content.decode(response.apparent_encoding))
+    if os.path.exists(data_path) and not force_download:
+        return data_path
+    import requests
+
+    # ensure data dir is created
+    os.makedirs('data', exist_ok=True)
+    # the body is first written to a .part file, and the validators of the file are kept in a .meta file
+    part_path = data_path + '.part'
+    meta_path = data_path + '.meta'
+    meta = _read_download_meta(meta_path)
+
+    while True:
+        headers = {}
+        # Conditional request: only download the file again if it changed
+        if os.path.exists(data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        # Resume an interrupted download, unless the remote file changed in between (If-Range)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if meta.get('part_etag') or meta.get('part_last_modified'):
+                headers['If-Range'] = meta.get('part_etag') or meta['part_last_modified']
 
+        with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                return data_path
+            if response.status_code == 416:
+                # The partial file does not match the remote one anymore: start again from scratch
+                os.remove(part_path)
+                continue
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            # Keep what is needed to resume this download before writing any byte
+            declared_encoding = _declared_encoding(response.headers.get('Content-Type'))
+            meta.update(part_etag=response.headers.get('ETag'),
+                        part_last_modified=response.headers.get('Last-Modified'),
+                        part_encoding=declared_encoding or (meta.get('part_encoding') if offset else None))
+            _write_download_meta(meta_path, meta)
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                    f.write(block)
+        break
+
+    _finalize_download(part_path, data_path, encoding or meta['part_encoding'] or 'utf-8')
+    _write_download_meta(meta_path, {'url': url, 'etag': meta['part_etag'], 'last_modified': meta['part_last_modified']})
     return data_path
 
 
-def load_formatted_data(data_fname:str) -> pd.DataFrame:
-    """ One function to read csv into a dataframe with appropriate types/formats.
-        Note: read only pertinent columns, ignore the others.
+# Concurrent downloads (fetch_all): connections open at once, in total and to the same host,
+# and retries of failed downloads, the first one after FETCH_BACKOFF seconds, then twice as long each time
+FETCH_MAX_CONNECTIONS = 8
+FETCH_MAX_PER_HOST = 2
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+
+
+def _retryable(error:Exception) -> bool:
+    """ Network errors, timeouts and 429/5xx responses are worth another try, other HTTP errors are not"""
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code == 429 or error.response.status_code >= 500)
+    return isinstance(error, requests.RequestException)
+
+
+async def fetch_all(urls:list, force_download=False, encoding:str=None, timeout:float=60,
+                    max_connections:int=FETCH_MAX_CONNECTIONS, max_per_host:int=FETCH_MAX_PER_HOST,
+                    retries:int=FETCH_RETRIES, backoff:float=FETCH_BACKOFF) -> dict:
+    """ Download many URLs concurrently into data/, each exactly as download_data does (it runs in a thread per
+        connection): resumed .part files, conditional requests with force_download, utf-8 transcoding.
+        A retry resumes what the failed attempt had downloaded. timeout is the connect and read timeout of requests.
+        Returns {url: data path}, or {url: exception} for the URLs which could not be downloaded.
     """
-    # Load the dataset
-    raw_dataset = pd.read_csv(data_fname, usecols=['nom', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt', 'dermnt', 'lat_coor1', 'long_coor1'], encoding ='utf-8')
-    
-    # Copy the loaded dataset to keep the original one 
-    cleaned_dataset = raw_dataset.copy()
-    
-    # Replace all empty strings with null values
-    cleaned_dataset = cleaned_dataset.replace([' '], pd.NA)
+    import asyncio
+    from urllib.parse import urlsplit
+    data_paths = {}
+    for url in urls:
+        data_path = os.path.join('data', os.path.basename(url.split('?')[0]))
+        if data_paths.setdefault(data_path, url) != url:
+            raise ValueError(f"{data_paths[data_path]} and {url} would both be downloaded into {data_path}")
+    pool = asyncio.Semaphore(max_connections)
+    hosts = {}
+
+    async def fetch(url):
+        host = hosts.setdefault(urlsplit(url).netloc, asyncio.Semaphore(max_per_host))
+        for attempt in range(retries + 1):
+            try:
+                # The host slot first, so that a download waiting for its host does not hold a connection of the pool
+                async with host, pool:
+                    return await asyncio.to_thread(download_data, url, force_download, encoding, timeout)
+            except Exception as e:
+                if attempt == retries or not _retryable(e):
+                    raise
+            await asyncio.sleep(backoff * 2**attempt)
+
+    results = await asyncio.gather(*(fetch(url) for url in dict.fromkeys(urls)), return_exceptions=True)
+    return dict(zip(dict.fromkeys(urls), results))
+
+
+def download_all(urls:list, **kwargs) -> dict:
+    """ fetch_all for synchronous callers"""
+    import asyncio
+    return asyncio.run(fetch_all(urls, **kwargs))
+
+
+# Pertinent columns of the raw dataset, the others are never read
+RAW_COLUMNS = ['nom', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt', 'dermnt', 'lat_coor1', 'long_coor1']
+STRING_COLUMNS = ['nom', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt']
+NUMERIC_COLUMNS = ['lat_coor1', 'long_coor1']
+
+# Values read as null in every raw column, and in some columns only, on top of DEFAULT_NA_VALUES: the default null
+# values of pandas, spelled out so that every parser engine is given the same ones (pyarrow lacks 'None' and '<NA>')
+DEFAULT_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+                     'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+NA_VALUES = [' ']
+COLUMN_NA_VALUES = {'lat_coor1': ['-'], 'long_coor1': ['-']}
+PARSER_ENGINES = ('c', 'pyarrow', 'projected')
+
+# Number of raw rows cleaned at once in streaming mode
+CHUNKSIZE = 100_000
+
+# Clean data file formats, by file extension
+CLEAN_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+# Version of the cleaning code: bump it whenever a change modifies the clean output, so that cached results are not reused.
+# The registered sanitizing rules are part of the version too, see cleaning_version.
+CLEANING_VERSION = 1
+CACHE_DIR = 'data/.cache'
+CACHE_MAX_BYTES = 512 * 2**20
+CACHE_ENTRY_NAME = re.compile(r'^[0-9a-f]{64}-v.+\.pkl$')
+
+# Raw columns identifying an AED between two publications of the dataset, and state of the last incremental cleaning
+KEY_COLUMNS = ['id', 'ref']
+# (in its own directory: the files of the cache directory are CleanDataCache entries)
+INCREMENTAL_STATE_PATH = 'data/.cache/incremental/state.pkl'
+
+# Projected copies of the raw files, read by the 'projected' parser engine (see project_raw_data)
+PROJECTION_DIR = 'data/.cache/raw'
+
+
+class PipelineProfile:
+    """ Opt-in profiling of the cleaning pipeline: wall time, peak traced memory and number of rows of
+        each stage, and of each column rule of sanitize_data.
+        Peak memory is measured with tracemalloc, which slows the pipeline down while it is profiled.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def stage(self, name:str):
+        """ Profile the enclosed code. The yielded record has to be given the number of rows processed."""
+        if not self._stack and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        start_memory, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            # The peak is reset below: keep the one the enclosing stage reached so far
+            self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'peak': start_memory}
+        self._stack.append(frame)
+        record = {'stage': name, 'rows': None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = peak - start_memory
+            self._stack.pop()
+            if self._stack:
+                # Nested stages reset the peak: hand it over to the enclosing stage
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+            elif self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            self.records.append(record)
+
+    def report(self) -> list:
+        """ One dict per profiled stage (stage, rows, seconds, peak_bytes), in the order they finished"""
+        return [dict(record) for record in self.records]
+
+    def to_json(self, path:str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def _stage(profile:PipelineProfile, name:str):
+    """ profile.stage(name), or a context doing nothing when no profile is given"""
+    if profile is None:
+        return contextlib.nullcontext({})
+    return profile.stage(name)
+
+
+class QualityReport:
+    """ Opt-in data quality counters, collected by the cleaning functions on the values they already go through
+        (on the distinct values of the sanitized columns): nothing is scanned again. For each raw column:
+        missing: null values as read (blank cells, and '-' in the coordinates, nulled by the csv parser),
+                 counted by format_data,
+        parse_failures: non null values which are not a date (dermnt) or a number (coordinates read as text),
+        nulls_introduced: values nulled by the cleaning rules (dates in the maintenance frequency by format_data,
+                          placeholders by sanitize_data),
+        rewritten: values modified by the sanitizing rules,
+        rules: rows nulled or modified by each rule, by rule name ('date' for the dates nulled by format_data).
+        Each function counts what it does, so that the counters are right whether it runs alone or in the pipeline;
+        stages gives the rows gone through each of them, rows the most of them.
+    """
+
+    COUNTERS = ('missing', 'parse_failures', 'nulls_introduced', 'rewritten')
+
+    def __init__(self):
+        self.stages = {}
+        self.columns = {}
+
+    @property
+    def rows(self) -> int:
+        return max(self.stages.values(), default=0)
+
+    def count_rows(self, stage:str, n_rows:int) -> None:
+        self.stages[stage] = self.stages.get(stage, 0) + int(n_rows)
+
+    def column(self, name:str) -> dict:
+        """ Counters of a column, created on first use"""
+        if name not in self.columns:
+            self.columns[name] = {**dict.fromkeys(self.COUNTERS, 0), 'rules': {}}
+        return self.columns[name]
+
+    def count_rule(self, column:str, rule:str, n_rows:int) -> None:
+        rules = self.column(column)['rules']
+        rules[rule] = rules.get(rule, 0) + int(n_rows)
+
+    def merge(self, other:QualityReport) -> QualityReport:
+        """ Add the counters of another report, e.g. of another chunk of the same file"""
+        for stage, n_rows in other.stages.items():
+            self.count_rows(stage, n_rows)
+        for name, counters in other.columns.items():
+            column = self.column(name)
+            for counter in self.COUNTERS:
+                column[counter] += counters[counter]
+            for rule, n_rows in counters['rules'].items():
+                self.count_rule(name, rule, n_rows)
+        return self
+
+    def report(self) -> dict:
+        """ Number of rows cleaned, and the counters of each column"""
+        return {'rows': self.rows, 'stages': dict(self.stages),
+                'columns': {name: {**counters, 'rules': dict(counters['rules'])} for name, counters in self.columns.items()}}
+
+    def to_json(self, path:str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
 
-    # Convert all string columns to string
-    cleaned_dataset[['nom', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt']] = cleaned_dataset[['nom', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt']].astype('string')
+
+def _raw_header(data_fname:str) -> list:
+    """ Column names of a raw csv, in the order of the file"""
+    with open(data_fname, encoding='utf-8-sig', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def _read_raw_table(data_fname:str, columns:list):
+    """ Columns of the raw csv as an Arrow table, read by the multithreaded pyarrow parser,
+        with the same null values as the 'c' engine
+    """
+    pa = _import_pyarrow()
+    import pyarrow.compute as pc
+    # The columns with null values of their own are read as text, nulled, then converted
+    masked_columns = [column for column in columns if column in COLUMN_NA_VALUES]
+    text_columns = [column for column in columns if column not in NUMERIC_COLUMNS or column in masked_columns]
+    convert_options = pa.csv.ConvertOptions(include_columns=columns,
+                                            column_types=dict.fromkeys(text_columns, pa.string()),
+                                            null_values=DEFAULT_NA_VALUES + NA_VALUES,
+                                            strings_can_be_null=True)
+    table = pa.csv.read_csv(data_fname, convert_options=convert_options)
+    for column in masked_columns:
+        values = table[column]
+        values = pc.if_else(pc.is_in(values, value_set=pa.array(COLUMN_NA_VALUES[column])), pa.scalar(None, pa.string()), values)
+        if column in NUMERIC_COLUMNS:
+            try:
+                values = values.cast(pa.float64())
+            except pa.ArrowInvalid:
+                # Other values are not numbers either: left as text, as the 'c' engine does, for format_data
+                pass
+        table = table.set_column(table.schema.get_field_index(column), column, values)
+    return table
+
+
+def project_raw_data(data_fname:str, extra_columns:list=(), projection_dir:str=None) -> str:
+    """ Projected copy of a raw csv, read by the 'projected' parser engine: only its pertinent columns, the key
+        columns and the extra columns, parsed once by the pyarrow parser into an uncompressed Arrow IPC file,
+        which is then memory-mapped instead of parsing the whole csv again.
+        The copy is written on first use, and identified by the path, size and modification time of the raw file
+        (not its content, which would have to be read again). Returns the path of the copy.
+        projection_dir: directory of the copies, PROJECTION_DIR by default.
+    """
+    projection_dir = PROJECTION_DIR if projection_dir is None else projection_dir
+    columns = [column for column in _raw_header(data_fname)
+               if column in RAW_COLUMNS or column in KEY_COLUMNS or column in extra_columns]
+    stat = os.stat(data_fname)
+    path_key = hashlib.sha256(os.path.abspath(data_fname).encode()).hexdigest()[:16]
+    # The null values are part of the key, copies read with other ones are not reused
+    version_key = hashlib.sha256(f'{stat.st_size}:{stat.st_mtime_ns}:{columns}:{DEFAULT_NA_VALUES}:{NA_VALUES}:{COLUMN_NA_VALUES}'.encode()).hexdigest()[:16]
+    projection_path = os.path.join(projection_dir, f'{path_key}-{version_key}.arrow')
+    if os.path.exists(projection_path):
+        return projection_path
+
+    pa = _import_pyarrow()
+    table = _read_raw_table(data_fname, columns)
+    os.makedirs(projection_dir, exist_ok=True)
+    # Write then rename, so that a reader never sees a partial copy
+    with pa.ipc.new_file(projection_path + '.tmp', table.schema) as writer:
+        writer.write_table(table)
+    os.replace(projection_path + '.tmp', projection_path)
+    # Copies of previous versions of the raw file are not needed anymore
+    for name in os.listdir(projection_dir):
+        if name.startswith(path_key) and name.endswith('.arrow') and name != os.path.basename(projection_path):
+            os.remove(os.path.join(projection_dir, name))
+    return projection_path
+
+
+def _arrow_to_pandas(table) -> pd.DataFrame:
+    pa = _import_pyarrow()
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+
+
+def _iter_arrow_chunks(table, chunksize:int):
+    """ Dataframes of chunksize rows of a table, indexed by their position in the file as the chunks of read_csv"""
+    for start in range(0, table.num_rows, chunksize):
+        chunk = _arrow_to_pandas(table.slice(start, chunksize))
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        yield chunk
+
+
+def read_raw_data(data_fname:str, chunksize:int=None, parser_engine:str='c', extra_columns:list=()):
+    """ Read the pertinent columns of the raw csv, as a dataframe or as an iterator of dataframes if chunksize is set.
+        Null values and the types of the string columns are declared to the parser, so that the columns come out typed.
+        parser_engine: 'c' (pandas parser), 'pyarrow' (multithreaded, needs pyarrow, cannot read by chunks)
+                       or 'projected' (memory-mapped projected copy of the csv, written on first use, see project_raw_data).
+        extra_columns: other raw columns to read as strings, when they exist.
+    """
+    columns = [column for column in _raw_header(data_fname) if column in RAW_COLUMNS or column in extra_columns]
+    text_columns = [column for column in columns if column not in NUMERIC_COLUMNS]
+    if parser_engine == 'pyarrow':
+        if chunksize is not None:
+            raise ValueError("The pyarrow parser engine cannot read a csv by chunks, use the 'c' or 'projected' engine")
+        return _arrow_to_pandas(_read_raw_table(data_fname, columns))
+    if parser_engine == 'projected':
+        pa = _import_pyarrow()
+        # Memory-mapped: only the pages of the selected columns are read from the disk
+        with pa.memory_map(project_raw_data(data_fname, extra_columns)) as source:
+            table = pa.ipc.open_file(source).read_all().select(columns)
+        return _arrow_to_pandas(table) if chunksize is None else _iter_arrow_chunks(table, chunksize)
+    if parser_engine != 'c':
+        raise ValueError(f"Unknown parser engine {parser_engine!r}, expected one of {PARSER_ENGINES}")
+    return pd.read_csv(data_fname, usecols=columns, dtype=dict.fromkeys(text_columns, 'string'),
+                       na_values={column: DEFAULT_NA_VALUES + NA_VALUES + COLUMN_NA_VALUES.get(column, []) for column in columns},
+                       keep_default_na=False, encoding ='utf-8', chunksize=chunksize)
+
+
+def _to_datetime_on_unique_values(s:pd.Series, **kwargs) -> pd.Series:
+    """ pd.to_datetime(s, errors='coerce') computed once per distinct value (dates repeat a lot)"""
+    codes, uniques = pd.factorize(s)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), errors='coerce', **kwargs).to_numpy(dtype='datetime64[ns]')
+    # Null values (code -1) take the NaT appended at the end
+    return pd.Series(np.append(parsed, np.datetime64('NaT', 'ns'))[codes], index=s.index, name=s.name)
+
+
+def format_data(raw_dataset:pd.DataFrame, quality:QualityReport=None) -> pd.DataFrame:
+    """ One function to give appropriate types/formats to raw columns, as read by read_raw_data.
+        quality: QualityReport counting the missing values, the parse failures and the dates nulled.
+    """
+    cleaned_dataset = raw_dataset.copy(deep=False)
+    if quality is not None:
+        quality.count_rows('format_data', len(raw_dataset))
+        for column in RAW_COLUMNS:
+            quality.column(column)['missing'] += int(raw_dataset[column].isna().sum())
+
+    # Convert all string columns to string (already done by the parser, unless the frame was read otherwise)
+    for column in STRING_COLUMNS:
+        if cleaned_dataset[column].dtype != 'string':
+            cleaned_dataset[column] = cleaned_dataset[column].astype('string')
 
     # Convert the last maintenance to the datetime format, and replace values ​​that are not convertible to null values
-    cleaned_dataset['dermnt']=pd.to_datetime(cleaned_dataset['dermnt'], errors='coerce', format='%Y-%m-%d')
+    cleaned_dataset['dermnt'] = _to_datetime_on_unique_values(cleaned_dataset['dermnt'], format='%Y-%m-%d')
+    if quality is not None:
+        quality.column('dermnt')['parse_failures'] += int(cleaned_dataset['dermnt'].isna().sum() - raw_dataset['dermnt'].isna().sum())
 
     # Convert values that have a date format in maintenance frequency to null values
-    cleaned_dataset['freq_mnt'] = cleaned_dataset['freq_mnt'].where(pd.to_datetime(cleaned_dataset['freq_mnt'], errors='coerce').isna(), pd.NA)
+    # (each value is parsed on its own, so the result does not depend on the other rows)
+    freq_dates = _to_datetime_on_unique_values(cleaned_dataset['freq_mnt'], format='mixed')
+    cleaned_dataset['freq_mnt'] = cleaned_dataset['freq_mnt'].where(freq_dates.isna(), pd.NA)
+    if quality is not None:
+        n_dates = int(freq_dates.notna().sum())
+        quality.column('freq_mnt')['nulls_introduced'] += n_dates
+        quality.count_rule('freq_mnt', 'date', n_dates)
 
-    # Convert latitude and longitude data to string, and if it's not possible set null values
-    cleaned_dataset['lat_coor1'] = pd.to_numeric(cleaned_dataset['lat_coor1'], errors='coerce')
-    cleaned_dataset['long_coor1'] = pd.to_numeric(cleaned_dataset['long_coor1'], errors='coerce')
+    # Convert latitude and longitude data to numbers when the parser could not, and if it's not possible set null values
+    for column in NUMERIC_COLUMNS:
+        if not pd.api.types.is_float_dtype(cleaned_dataset[column]):
+            cleaned_dataset[column] = pd.to_numeric(cleaned_dataset[column].astype(object), errors='coerce')
+            if quality is not None:
+                quality.column(column)['parse_failures'] += int(cleaned_dataset[column].isna().sum() - raw_dataset[column].isna().sum())
 
     return cleaned_dataset
 
 
-# once they are all done, call them in the general sanitizing function
-def sanitize_data(df:pd.DataFrame) -> pd.DataFrame:
-    """ One function to do all sanitizing
+def load_formatted_data(data_fname:str, parser_engine:str='c', quality:QualityReport=None) -> pd.DataFrame:
+    """ One function to read csv into a dataframe with appropriate types/formats.
+        Note: read only pertinent columns, ignore the others.
+    """
+    # No copy of the loaded dataset: format_data never modifies it in place
+    return format_data(read_raw_data(data_fname, parser_engine=parser_engine), quality)
+
+
+# Patterns of the sanitizing rules, compiled once at import
+ADR_NUM_RANGE = re.compile(r'^\d+\s*-\s*\d+$')
+ADR_NUM_DASH = re.compile(r'\s*-\s*')
+ADR_NUM_JUNK = re.compile(r'^(\d+)(?!\s*bis)\D+')
+ADR_VOIE_ZIP_MATCH = re.compile(r'.*\b\d{5}\b.*')
+ADR_VOIE_ZIP = re.compile(r'\s*\b\d{5}\b.*')
+ADR_VOIE_SPACES_MATCH = re.compile(r'.*\s{2,}.*')
+ADR_VOIE_SPACES = re.compile(r'\s{2,}')
+ADR_VOIE_NUM = re.compile(r'^\d+\s+')
+ADR_VOIE_COMMA_MATCH = re.compile(r'.*,.*')
+ADR_VOIE_COMMA = re.compile(r',.*')
+WHITESPACES = re.compile(r'\s+')
+TEL_DIGITS = re.compile(r'([^3])\s*(\d{2})\s*(\d{2})\s*(\d{2})\s*(\d{2})')
+FREQ_TOUT_MATCH = re.compile(r'Tout.*')
+FREQ_TOUT = re.compile(r'Tout')
+
+# 'unique' applies the rules once per distinct value; 'vectorized', its former name, is still accepted
+SANITIZE_ENGINES = ('unique', 'loop')
+SANITIZE_ENGINE_ALIASES = {'vectorized': 'unique'}
+
+
+def _sanitize_data_loop(df:pd.DataFrame) -> pd.DataFrame:
+    """ Legacy row by row sanitizing, kept as a reference for the unique engine
     """
     
     # Address number
@@ -118,38 +587,851 @@ def sanitize_data(df:pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+
+class SanitizingRule:
+    """ One declarative sanitizing rule on a raw column. Applied to a non null value, in this order:
+        nulls: values replaced by a null value (the next rules are skipped),
+        when / unless: the rule only applies if the value matches `when` and does not match `unless` (re.match),
+        pattern / replacement: regex substitution (replacement may be a string or a function of the match),
+        transform: function applied to the value.
+        Rules of a column run by increasing order, then by registration.
+    """
+
+    def __init__(self, column:str, order:int, pattern=None, replacement='', when=None, unless=None, transform=None,
+                 nulls=(), name:str=None):
+        self.column = column
+        self.order = order
+        # Patterns are compiled once, when the rule is declared
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.replacement = replacement
+        self.when = re.compile(when) if when is not None else None
+        self.unless = re.compile(unless) if unless is not None else None
+        self.transform = transform
+        self.nulls = frozenset(nulls)
+        self.name = name or (self.pattern.pattern if self.pattern is not None else getattr(transform, '__name__', 'nulls'))
+
+    def __repr__(self):
+        return f"SanitizingRule({self.column!r}, {self.order}, {self.name!r})"
+
+
+# Registry of the sanitizing rules of every column
+SANITIZING_RULES = []
+
+
+def register_rule(column:str, order:int, **kwargs) -> SanitizingRule:
+    """ Declare a sanitizing rule (see SanitizingRule), e.g. a region-specific one.
+        All the rules of a column are applied in a single pass over its distinct values.
+    """
+    rule = SanitizingRule(column, order, **kwargs)
+    SANITIZING_RULES.append(rule)
+    return rule
+
+
+def _title_last_word(value:str) -> str:
+    """ Words joined by single spaces, the last one with capitals"""
+    words = value.split()
+    if words:
+        words[-1] = words[-1].title()
+    return ' '.join(words)
+
+
+def _format_phone(value:str) -> str:
+    """ +33 format, from the first group of digits found"""
+    digits = TEL_DIGITS.search(value)
+    return "+33 {} {} {} {} {}".format(*digits.groups()) if digits else value
+
+
+# Address number
+register_rule('adr_num', 10, nulls=['-'], name='dash')
+# Delete space around -
+register_rule('adr_num', 20, when=ADR_NUM_RANGE, pattern=ADR_NUM_DASH, replacement='-', name='range_spaces')
+# Delete unwanted characters
+register_rule('adr_num', 30, when=ADR_NUM_JUNK, unless=ADR_NUM_RANGE, pattern=ADR_NUM_JUNK, replacement=r'\1',
+              name='junk_after_number')
+
+# Name of the street
+register_rule('adr_voie', 10, nulls=['-'], name='dash')
+# If there is the total address in this field, we remove unnecassary stuff (from the zip code)
+register_rule('adr_voie', 20, when=ADR_VOIE_ZIP_MATCH, pattern=ADR_VOIE_ZIP, name='zip_code_and_city')
+# If there is more than two spaces, we only put one
+register_rule('adr_voie', 30, when=ADR_VOIE_SPACES_MATCH, pattern=ADR_VOIE_SPACES, replacement=' ', name='spaces')
+# If there is the number of the street, we delete it
+register_rule('adr_voie', 40, pattern=ADR_VOIE_NUM, name='street_number')
+# We delete all stuff after commas
+register_rule('adr_voie', 50, when=ADR_VOIE_COMMA_MATCH, pattern=ADR_VOIE_COMMA, name='after_comma')
+# We have to put caps on the last word
+register_rule('adr_voie', 60, transform=_title_last_word, name='last_word_title')
+
+# ZIP code
+register_rule('com_cp', 10, nulls=['0'], name='zero')
+
+# City name
+# We have to put the last word with a cap on the first letter, and the rest in small letters
+register_rule('com_nom', 10, transform=str.capitalize)
+
+# Phone number
+register_rule('tel1', 10, nulls=['-'], name='dash')
+register_rule('tel1', 20, transform=_format_phone, name='international_format')
+
+# Maintenance frequency
+register_rule('freq_mnt', 10, transform=str.capitalize)
+# Spelling mistakes correction
+register_rule('freq_mnt', 20, when=FREQ_TOUT_MATCH, pattern=FREQ_TOUT, replacement='Tous', name='tout_spelling')
+
+
+def _fuse_rules(rules:list):
+    """ One function applying a chain of rules to a single value.
+        hits: one list per rule, the position of the value is appended to the lists of the rules which nulled
+        or modified it.
+    """
+    steps = [(rule.nulls, rule.when, rule.unless, rule.pattern, rule.replacement, rule.transform) for rule in rules]
+
+    def apply(value, hits:list=None, position:int=None):
+        for step, (nulls, when, unless, pattern, replacement, transform) in enumerate(steps):
+            if value in nulls:
+                if hits is not None:
+                    hits[step].append(position)
+                return pd.NA
+            if when is not None and not when.match(value):
+                continue
+            if unless is not None and unless.match(value):
+                continue
+            before = value
+            if pattern is not None:
+                value = pattern.sub(replacement, value)
+            if transform is not None:
+                value = transform(value)
+            if hits is not None and value != before:
+                hits[step].append(position)
+        return value
+
+    return apply
+
+
+def column_rules() -> dict:
+    """ Registered rules grouped by column, each list sorted by order; columns come in the order of their first rule"""
+    by_column = {}
+    for rule in SANITIZING_RULES:
+        by_column.setdefault(rule.column, []).append(rule)
+    return {column: sorted(rules, key=lambda rule: rule.order) for column, rules in by_column.items()}
+
+
+def _callable_name(function) -> str:
+    return f"{getattr(function, '__module__', '')}.{getattr(function, '__qualname__', repr(function))}"
+
+
+def _rule_fingerprint(rule:SanitizingRule) -> tuple:
+    """ What a rule does, as far as it can be told without running it: functions are known by their names only"""
+    def pattern(regex):
+        return None if regex is None else (regex.pattern, regex.flags)
+
+    replacement = rule.replacement if isinstance(rule.replacement, str) else _callable_name(rule.replacement)
+    transform = None if rule.transform is None else _callable_name(rule.transform)
+    return (rule.column, rule.order, rule.name, pattern(rule.pattern), replacement, pattern(rule.when),
+            pattern(rule.unless), transform, sorted(rule.nulls))
+
+
+def cleaning_version() -> str:
+    """ Version of the clean output: CLEANING_VERSION and a fingerprint of the registered sanitizing rules,
+        so that cached and incremental results are not reused once a rule is registered or changed.
+    """
+    fingerprint = hashlib.sha256(repr([_rule_fingerprint(rule) for rule in SANITIZING_RULES]).encode()).hexdigest()[:12]
+    return f'{CLEANING_VERSION}-{fingerprint}'
+
+
+def _column_sanitizer(rules:list):
+    """ Sanitizer of a column: the fused rules, applied in one pass over the values"""
+    apply = _fuse_rules(rules)
+
+    def sanitize(s:pd.Series, hits:dict=None) -> pd.Series:
+        """ hits: dict given the positions of the values nulled or modified by each rule, by rule name"""
+        if hits is None:
+            values = [apply(value) for value in s]
+        else:
+            rule_hits = [[] for _ in rules]
+            values = [apply(value, rule_hits, position) for position, value in enumerate(s)]
+            for rule, positions in zip(rules, rule_hits):
+                hits[rule.name] = hits.get(rule.name, []) + positions
+        return pd.Series(values, index=s.index, name=s.name, dtype='string')
+
+    return sanitize
+
+
+def _on_unique_values(s:pd.Series, sanitizer, stats:dict=None, quality:QualityReport=None) -> pd.Series:
+    """ Apply a column sanitizer once per distinct value, and broadcast the results back to every row.
+        Columns like the city or the maintenance frequency only have a handful of distinct values.
+        The quality counters are counted on the distinct values too, weighted by their number of rows
+        (the null values are counted as missing by format_data, not here).
+    """
+    codes, uniques = pd.factorize(s)
+    if stats is not None:
+        n_values = int((codes >= 0).sum())
+        stats[s.name] = {'rows': len(s), 'values': n_values, 'unique': len(uniques),
+                         'hit_ratio': 1 - len(uniques) / n_values if n_values else 0.0}
+    # Null values stay null
+    if len(uniques) == 0:
+        return s
+    hits = {} if quality is not None else None
+    sanitized = sanitizer(pd.Series(uniques, dtype=s.dtype), hits).array
+    if quality is not None:
+        _count_rewrites(quality.column(s.name), uniques, sanitized, hits, np.bincount(codes[codes >= 0], minlength=len(uniques)))
+    return pd.Series(sanitized.take(codes, allow_fill=True), index=s.index, name=s.name)
+
+
+def _count_rewrites(counters:dict, uniques, sanitized, hits:dict, n_rows:np.ndarray) -> None:
+    """ Quality counters of a sanitized column, from its distinct values and their number of rows"""
+    nulled = np.asarray(pd.isna(sanitized), dtype=bool)
+    # Values modified by any rule, rather than compared with their sanitized version (many distinct phone numbers)
+    modified = np.zeros(len(uniques), dtype=bool)
+    rules = counters['rules']
+    for name, positions in hits.items():
+        if positions:
+            modified[positions] = True
+            rules[name] = rules.get(name, 0) + int(n_rows[positions].sum())
+    counters['nulls_introduced'] += int(n_rows[nulled].sum())
+    counters['rewritten'] += int(n_rows[modified & ~nulled].sum())
+
+
+def _sanitize_data_unique(df:pd.DataFrame, stats:dict=None, profile:PipelineProfile=None,
+                          quality:QualityReport=None) -> pd.DataFrame:
+    """ Column-wise sanitizing with the registered rules, same results as the legacy row loop.
+        The rules themselves run in a Python loop, once per distinct value of each column: only the factorization
+        and the mapping of the sanitized values back to the rows are vectorized.
+    """
+    if quality is not None:
+        quality.count_rows('sanitize_data', len(df))
+    for column, rules in column_rules().items():
+        with _stage(profile, f'sanitize_data.{column}') as record:
+            df[column] = _on_unique_values(df[column], _column_sanitizer(rules), stats, quality)
+            record['rows'] = len(df)
+    return df
+
+
+# once they are all done, call them in the general sanitizing function
+def sanitize_data(df:pd.DataFrame, engine:str='unique', stats:dict=None, profile:PipelineProfile=None,
+                  quality:QualityReport=None) -> pd.DataFrame:
+    """ One function to do all sanitizing
+        engine: 'unique' (default, also accepted as 'vectorized') works column-wise, applying the rules in Python
+                once per distinct value: fast when values repeat, as in the exports, but close to one call per row
+                on columns with mostly distinct values (tel1). 'loop' is the legacy row by row version.
+        stats: dict filled, for the unique engine, with the number of rows, non null values and distinct
+               values of each sanitized column, and the ratio of values served without applying the rules again.
+        profile: PipelineProfile recording each column rule of the unique engine.
+        quality: QualityReport counting, for the unique engine, the values nulled and modified by each rule.
+    """
+    engine = SANITIZE_ENGINE_ALIASES.get(engine, engine)
+    if engine == 'unique':
+        return _sanitize_data_unique(df, stats, profile, quality)
+    if engine == 'loop':
+        return _sanitize_data_loop(df)
+    raise ValueError(f"Unknown sanitizing engine {engine!r}, expected one of {SANITIZE_ENGINES}")
+
+
+# Raw address columns merged into the Address column by frame_data
+ADDRESS_COLUMNS = ['adr_num', 'adr_voie', 'com_cp', 'com_nom']
+FRAMED_NAMES = {'nom':'Name', 'tel1':'Phone number', 'freq_mnt':'Maintenance frequency', 'dermnt':'Last maintenance', 'lat_coor1':'Latitude', 'long_coor1':'Longitude'}
+
+
 # Define a framing function
-def frame_data(df:pd.DataFrame) -> pd.DataFrame:
-    """ One function all framing (column renaming, column merge)"""
-    final_df = df.copy()
-    #Column renaming
-    final_df.rename(columns={'nom':'Name', 'tel1':'Phone number', 'freq_mnt':'Maintenance frequency', 'dermnt':'Last maintenance', 'lat_coor1':'Latitude', 'long_coor1':'Longitude'}, inplace=True)
+def frame_data(df:pd.DataFrame, inplace:bool=False) -> pd.DataFrame:
+    """ One function all framing (column renaming, column merge)
+        inplace: frame df itself instead of a copy, for pipelines that do not need the sanitized dataframe anymore.
+    """
     # Creation of the Address column, merging all independant address columns
-    final_df.insert(1, 'Address', final_df['adr_num'].fillna('') + ' ' + final_df['adr_voie'].fillna('') + ' ' + final_df['com_cp'].fillna('') + ' ' + final_df['com_nom'].fillna(''))
+    address = df['adr_num'].fillna('') + ' ' + df['adr_voie'].fillna('') + ' ' + df['com_cp'].fillna('') + ' ' + df['com_nom'].fillna('')
     # Delete double/triple spaces
-    for i in range(len(final_df)):
-        final_df.loc[i, 'Address']=' '.join(final_df.loc[i, 'Address'].split())
+    address = address.str.strip().str.replace(WHITESPACES, ' ', regex=True)
     # Set back null values if needed
-    final_df.loc[final_df['Address']=='', 'Address'] = pd.NA
-    # Delete merged columns
-    del final_df['adr_num']
-    del final_df['adr_voie']
-    del final_df['com_cp']
-    del final_df['com_nom']
+    address = address.mask(address == '')
+    # Delete merged columns (only the other columns are copied when not in place)
+    if inplace:
+        df.drop(columns=ADDRESS_COLUMNS, inplace=True)
+        final_df = df
+    else:
+        final_df = df.drop(columns=ADDRESS_COLUMNS)
+    #Column renaming
+    final_df.rename(columns=FRAMED_NAMES, inplace=True)
+    final_df.insert(1, 'Address', address)
     return final_df
 
 
-# once they are all done, call them in the general clean loading function
-def load_clean_data(data_path:str=DATA_PATH)-> pd.DataFrame:
-    """one function to run it all and return a clean dataframe"""
-    df = (load_formatted_data(data_path)
-          .pipe(sanitize_data)
-          .pipe(frame_data)
+# Compact clean frames (compact_clean_data): text columns with at most this ratio of distinct values become categoricals,
+# and the coordinates are stored as float32 when no value moves by more than COORDINATES_TOLERANCE degrees (about 1 m)
+CATEGORY_MAX_RATIO = 0.5
+COORDINATE_COLUMNS = ['Latitude', 'Longitude']
+COORDINATES_TOLERANCE = 1e-5
+# Phone numbers as written by the sanitizing rules, packed as the integer of their 9 national digits:
+# the positions of the digits and of the spaces in the characters of '+33 4 67 64 87 70'
+PHONE_COLUMN = 'Phone number'
+PHONE_TEMPLATE = b'+33 0 00 00 00 00'
+PHONE_DIGITS = [4, 6, 7, 9, 10, 12, 13, 15, 16]
+
+
+def _pack_phone_numbers(s:pd.Series):
+    """ Phone numbers as UInt32 national numbers, or None if some of them are not in the +33 format.
+        The characters of the numbers are checked and converted as a matrix of bytes, one row per number.
+    """
+    known = s.notna().to_numpy()
+    width = len(PHONE_TEMPLATE)
+    try:
+        # One more byte than the template, which is only null for numbers that are not longer than it
+        chars = np.array(s[known].to_numpy(dtype=object), dtype=f'S{width + 1}').view(np.uint8).reshape(-1, width + 1)
+    except UnicodeEncodeError:
+        return None
+    template = np.frombuffer(PHONE_TEMPLATE + b'\0', dtype=np.uint8)
+    others = np.ones(width + 1, dtype=bool)
+    others[PHONE_DIGITS] = False
+    digits = chars[:, PHONE_DIGITS] - ord('0')
+    if not ((chars[:, others] == template[others]).all() and (digits <= 9).all() and (digits[:, 0] > 0).all()):
+        return None
+    numbers = np.zeros(len(s), dtype=np.uint32)
+    numbers[known] = digits @ 10 ** np.arange(len(PHONE_DIGITS) - 1, -1, -1)
+    return pd.Series(pd.arrays.IntegerArray(numbers, ~known), index=s.index, name=s.name)
+
+
+def format_phone_numbers(s:pd.Series) -> pd.Series:
+    """ Packed phone numbers of a compact frame back to their +33 format"""
+    known = s.notna().to_numpy()
+    numbers = s[known].to_numpy(dtype=np.int64)
+    chars = np.tile(np.frombuffer(PHONE_TEMPLATE, dtype=np.uint8), (len(numbers), 1))
+    chars[:, PHONE_DIGITS] += (numbers[:, None] // 10 ** np.arange(len(PHONE_DIGITS) - 1, -1, -1) % 10).astype(np.uint8)
+    formatted = np.full(len(s), pd.NA, dtype=object)
+    formatted[known] = chars.view(f'S{len(PHONE_TEMPLATE)}').ravel().astype(str)
+    return pd.Series(formatted, index=s.index, name=s.name, dtype='string')
+
+
+def _dtype_name(dtype) -> str:
+    # string dtypes are all named 'string', whatever their storage
+    return f'string[{dtype.storage}]' if isinstance(dtype, pd.StringDtype) else str(dtype)
+
+
+def compact_clean_data(df:pd.DataFrame, memory:dict=None) -> pd.DataFrame:
+    """ Compact representation of a clean dataframe, for frames kept in memory: categoricals for the text columns
+        with few distinct values, Arrow strings for the others (when pyarrow is installed), float32 coordinates
+        when precise enough, and phone numbers packed as integers (see format_phone_numbers).
+        memory: dict filled with the dtype and bytes of each column, before and after.
+    """
+    compact = df.copy(deep=False)
+    arrow_strings = importlib.util.find_spec('pyarrow') is not None
+    for column in compact.columns:
+        s = compact[column]
+        if column == PHONE_COLUMN and s.dtype == 'string' and (packed := _pack_phone_numbers(s)) is not None:
+            compact[column] = packed
+        elif column in COORDINATE_COLUMNS and s.dtype == 'float64':
+            reduced = s.astype('float32')
+            if not (reduced.astype('float64') - s).abs().gt(COORDINATES_TOLERANCE).any():
+                compact[column] = reduced
+        elif s.dtype == 'string':
+            codes, uniques = pd.factorize(s)
+            if len(uniques) <= CATEGORY_MAX_RATIO * (codes >= 0).sum():
+                # Categories in the order of appearance: sorting them is most of the cost of astype('category')
+                compact[column] = pd.Categorical.from_codes(codes, pd.Index(uniques, dtype=s.dtype))
+            elif arrow_strings:
+                compact[column] = s.astype('string[pyarrow]')
+    if memory is not None:
+        before, after = df.memory_usage(deep=True), compact.memory_usage(deep=True)
+        for column in compact.columns:
+            memory[column] = {'dtype_before': _dtype_name(df[column].dtype), 'bytes_before': int(before[column]),
+                              'dtype_after': _dtype_name(compact[column].dtype), 'bytes_after': int(after[column])}
+    return compact
+
+
+def _clean_chunk(raw_chunk:pd.DataFrame, quality:QualityReport=None) -> pd.DataFrame:
+    """ Format, sanitize and frame a block of raw rows, keeping their position in the file as index"""
+    # The cleaning functions expect a 0-based index, the position in the file is restored afterwards
+    index = raw_chunk.index
+    chunk = (format_data(raw_chunk.reset_index(drop=True), quality)
+             .pipe(sanitize_data, quality=quality)
+             .pipe(frame_data, inplace=True)
     )
+    chunk.index = index
+    return chunk
+
+
+def _clean_chunk_with_quality(raw_chunk:pd.DataFrame):
+    """ _clean_chunk in a worker process: its quality counters are sent back with the clean rows"""
+    quality = QualityReport()
+    return _clean_chunk(raw_chunk, quality), quality
+
+
+# once they are all done, call them in the general clean loading function
+def load_clean_data(data_path:str=DATA_PATH, workers:int=1, cache:'CleanDataCache'=None, profile:PipelineProfile=None,
+                    parser_engine:str='c', quality:QualityReport=None, compact:bool=False)-> pd.DataFrame:
+    """one function to run it all and return a clean dataframe
+       data_path: raw csv to clean, or clean Parquet/Arrow file to read back as is.
+       workers: number of processes cleaning blocks of rows in parallel (1 runs everything in this process).
+       cache: CleanDataCache reused when the raw file has already been cleaned with the same rules.
+       profile: PipelineProfile recording each stage, and each sanitizing rule when run in this process.
+       parser_engine: csv parser reading the raw file, 'c' or 'pyarrow' (see read_raw_data).
+       quality: QualityReport given the data quality counters of the cleaning. A frame read back from
+                a clean file or from the cache is not cleaned again, and adds nothing to the report.
+       compact: return the compact representation of the clean dataframe (see compact_clean_data).
+    """
+    with _stage(profile, 'load_clean_data') as record:
+        df = _load_clean_data(data_path, workers, cache, profile, parser_engine, quality)
+        if compact:
+            df = compact_clean_data(df)
+        record['rows'] = len(df)
+    return df
+
+
+def _load_clean_data(data_path:str, workers:int, cache:CleanDataCache, profile:PipelineProfile, parser_engine:str,
+                     quality:QualityReport) -> pd.DataFrame:
+    # Already clean typed files are read back as they are
+    if CLEAN_FORMATS.get(os.path.splitext(str(data_path))[1].lower(), 'csv') != 'csv':
+        return read_clean_data(data_path)
+
+    if cache is not None:
+        return cache.load(data_path, workers=workers, parser_engine=parser_engine, quality=quality)
+
+    if workers > 1:
+        raw_dataset = read_raw_data(data_path, parser_engine=parser_engine)
+        if len(raw_dataset) > 0:
+            # One contiguous block of rows per worker, put back in the original order by map
+            block_size = -(-len(raw_dataset) // workers)
+            blocks = [raw_dataset.iloc[i:i + block_size] for i in range(0, len(raw_dataset), block_size)]
+            # Imported here, multiprocessing is not worth its import time for serial runs
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                if quality is None:
+                    return pd.concat(executor.map(_clean_chunk, blocks), ignore_index=True)
+                chunks = []
+                for chunk, chunk_quality in executor.map(_clean_chunk_with_quality, blocks):
+                    chunks.append(chunk)
+                    quality.merge(chunk_quality)
+                return pd.concat(chunks, ignore_index=True)
+
+    with _stage(profile, 'load_formatted_data') as record:
+        df = load_formatted_data(data_path, parser_engine=parser_engine, quality=quality)
+        record['rows'] = len(df)
+    with _stage(profile, 'sanitize_data') as record:
+        df = sanitize_data(df, profile=profile, quality=quality)
+        record['rows'] = len(df)
+    with _stage(profile, 'frame_data') as record:
+        df = frame_data(df, inplace=True)
+        record['rows'] = len(df)
     return df
 
 
+def file_hash(path:str) -> str:
+    """ sha256 of the content of a file, read by blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CleanDataCache:
+    """ On-disk cache of clean dataframes, keyed on the content of the raw file and on the cleaning_version.
+        The least recently used entries are evicted once the cache holds more than max_bytes.
+    """
+
+    def __init__(self, cache_dir:str=CACHE_DIR, max_bytes:int=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, content_hash:str) -> str:
+        return os.path.join(self.cache_dir, f'{content_hash}-v{cleaning_version()}.pkl')
+
+    def _entries(self) -> list:
+        """ Paths of the cached frames, least recently used first"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        # Only the files named by _entry_path, other files may share the directory
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if CACHE_ENTRY_NAME.match(name)]
+        return sorted(paths, key=os.path.getmtime)
+
+    def get(self, data_path:str):
+        """ Cached clean dataframe of the raw file, or None"""
+        entry_path = self._entry_path(file_hash(data_path))
+        if not os.path.exists(entry_path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Mark the entry as recently used for the eviction
+        os.utime(entry_path)
+        return pd.read_pickle(entry_path)
+
+    def put(self, data_path:str, df:pd.DataFrame) -> None:
+        """ Store the clean dataframe of the raw file, then evict old entries if needed"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_path = self._entry_path(file_hash(data_path))
+        # Write then rename, so that a reader never sees a partial entry
+        df.to_pickle(entry_path + '.tmp')
+        os.replace(entry_path + '.tmp', entry_path)
+        self._evict(keep=entry_path)
+
+    def _evict(self, keep:str) -> None:
+        entries = self._entries()
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                total -= os.path.getsize(path)
+                os.remove(path)
+
+    def load(self, data_path:str, workers:int=1, parser_engine:str='c', quality:QualityReport=None) -> pd.DataFrame:
+        """ load_clean_data, skipped when the raw file was already cleaned"""
+        df = self.get(data_path)
+        if df is None:
+            df = load_clean_data(data_path, workers=workers, parser_engine=parser_engine, quality=quality)
+            self.put(data_path, df)
+        return df
+
+    def invalidate(self, data_path:str=None) -> int:
+        """ Remove the entries of a raw file (every version of the rules), or the whole cache if no file is given.
+            Returns the number of removed entries.
+        """
+        prefix = file_hash(data_path) if data_path is not None else ''
+        removed = 0
+        for path in self._entries():
+            if os.path.basename(path).startswith(prefix):
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        """ Hit/miss counters of this cache object and current size of the cache directory"""
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'bytes': sum(os.path.getsize(path) for path in entries)}
+
+
+def _row_keys(ids:pd.DataFrame, row_hash:np.ndarray) -> pd.MultiIndex:
+    """ Key of each raw row: its id/ref columns, the hash of its pertinent values, and its rank among the
+        rows sharing both (id/ref are not unique in the exports, and some rows are repeated).
+    """
+    keys = ids.assign(row_hash=row_hash)
+    keys['occurrence'] = keys.groupby(list(keys.columns), dropna=False).cumcount()
+    return pd.MultiIndex.from_frame(keys)
+
+
+def update_clean_data(data_path:str=DATA_PATH, state_path:str=INCREMENTAL_STATE_PATH):
+    """ Incremental version of load_clean_data: only the raw rows added or modified since the previous call
+        (with the same state_path) are cleaned, the others are taken from the previous clean dataframe.
+        Returns the clean dataframe, in the order of the raw file, and the number of added, modified,
+        unchanged and removed rows.
+    """
+    raw_dataset = read_raw_data(data_path, extra_columns=KEY_COLUMNS)
+    ids = raw_dataset[[column for column in KEY_COLUMNS if column in raw_dataset.columns]]
+    # Keep the columns in the order of the file, as load_clean_data does
+    raw_dataset = raw_dataset[[column for column in raw_dataset.columns if column in RAW_COLUMNS]]
+    keys = _row_keys(ids, pd.util.hash_pandas_object(raw_dataset, index=False).to_numpy())
+
+    previous = None
+    if os.path.exists(state_path):
+        previous = pd.read_pickle(state_path)
+        # Results of other cleaning rules cannot be reused
+        if previous['version'] != cleaning_version():
+            previous = None
+
+    # Rows with the same ids and the same values as before are not cleaned again
+    if previous is None:
+        positions = np.full(len(raw_dataset), -1)
+    else:
+        positions = previous['keys'].get_indexer(keys)
+    unchanged = positions >= 0
+
+    parts = []
+    if (~unchanged).any():
+        parts.append(_clean_chunk(raw_dataset[~unchanged]))
+    if unchanged.any():
+        reused = previous['clean'].iloc[positions[unchanged]]
+        reused.index = raw_dataset.index[unchanged]
+        parts.append(reused)
+    if parts:
+        clean_df = pd.concat(parts).sort_index().reset_index(drop=True)
+    else:
+        clean_df = frame_data(sanitize_data(format_data(raw_dataset)), inplace=True)
+
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    pd.to_pickle({'version': cleaning_version(), 'keys': keys, 'ids': pd.MultiIndex.from_frame(ids) if ids.shape[1] else None, 'clean': clean_df}, state_path)
+
+    # Changed rows whose ids were already known are modified rows, the others are new ones
+    if previous is None or previous['ids'] is None or ids.shape[1] == 0:
+        modified = 0
+    else:
+        modified = int(pd.MultiIndex.from_frame(ids[~unchanged]).isin(previous['ids']).sum())
+    n_previous = 0 if previous is None else len(previous['keys'])
+    changes = {'added': int((~unchanged).sum()) - modified,
+               'modified': modified,
+               'unchanged': int(unchanged.sum()),
+               'removed': max(n_previous - int(unchanged.sum()) - modified, 0)}
+    return clean_df, changes
+
+
+def iter_clean_data(data_path:str=DATA_PATH, chunksize:int=CHUNKSIZE, quality:QualityReport=None,
+                    parser_engine:str='c'):
+    """ Streaming version of load_clean_data: yield clean dataframes of at most chunksize rows.
+        Only one chunk is held in memory at a time, whatever the size of the input file.
+        quality: QualityReport given the counters of every chunk, as they are cleaned.
+        parser_engine: 'c' or 'projected' (see read_raw_data).
+    """
+    for raw_chunk in read_raw_data(data_path, chunksize=chunksize, parser_engine=parser_engine):
+        yield _clean_chunk(raw_chunk, quality)
+
+
+def _import_pyarrow():
+    """ pyarrow is only needed for Parquet/Arrow files and the pyarrow parser, import it on demand"""
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("pyarrow is required for Parquet/Arrow files and for the pyarrow csv parser (pip install pyarrow)") from e
+    return pyarrow
+
+
+def _file_format(path:str) -> str:
+    """ Format of a clean data file, from its extension: 'csv', 'parquet' or 'arrow'"""
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension not in CLEAN_FORMATS:
+        raise ValueError(f"Unknown clean data file extension {extension!r}, expected one of {tuple(CLEAN_FORMATS)}")
+    return CLEAN_FORMATS[extension]
+
+
+class _CleanDataWriter:
+    """ Write clean dataframes one after the other into a single csv, Parquet or Arrow IPC (feather) file.
+        They are written into a .tmp file, which replaces the output on close: an interrupted write leaves
+        the previous output, never a truncated one.
+    """
+
+    def __init__(self, output_path:str):
+        self.output_path = output_path
+        self.tmp_path = os.fspath(output_path) + '.tmp'
+        self.file_format = _file_format(output_path)
+        self._writer = None
+        self._schema = None
+        self._n_chunks = 0
+
+    def write(self, df:pd.DataFrame) -> None:
+        # Compact frames are written as the others
+        if PHONE_COLUMN in df.columns and pd.api.types.is_integer_dtype(df[PHONE_COLUMN]):
+            df = df.assign(**{PHONE_COLUMN: format_phone_numbers(df[PHONE_COLUMN])})
+        if self.file_format == 'csv':
+            df.to_csv(self.tmp_path, index=False, mode='w' if self._n_chunks == 0 else 'a', header=self._n_chunks == 0)
+        else:
+            pa = _import_pyarrow()
+            # The pandas metadata stored in the schema gives back the exact dtypes on reading
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                if self.file_format == 'parquet':
+                    self._writer = pa.parquet.ParquetWriter(self.tmp_path, table.schema)
+                else:
+                    self._writer = pa.ipc.new_file(self.tmp_path, table.schema)
+            self._writer.write_table(table.cast(self._schema))
+        self._n_chunks += 1
+
+    def close(self, complete:bool=True) -> None:
+        """ Move the written file to the output, or remove it when the write is not complete"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if os.path.exists(self.tmp_path):
+            if complete:
+                os.replace(self.tmp_path, self.output_path)
+            else:
+                os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+
+def save_clean_data(df:pd.DataFrame, output_path:str) -> None:
+    """ Save a clean dataframe as csv, Parquet (.parquet) or Arrow IPC (.arrow/.feather), depending on the extension."""
+    with _CleanDataWriter(output_path) as writer:
+        writer.write(df)
+
+
+def read_clean_data(path:str) -> pd.DataFrame:
+    """ Read back a clean Parquet or Arrow IPC file with its dtypes, without any parsing.
+        The file is memory-mapped rather than read into a buffer.
+    """
+    file_format = _file_format(path)
+    if file_format == 'csv':
+        raise ValueError("read_clean_data needs a typed Parquet or Arrow file, csv files have to be cleaned with load_clean_data")
+    pa = _import_pyarrow()
+    if file_format == 'parquet':
+        table = pa.parquet.read_table(path, memory_map=True)
+    else:
+        table = pa.feather.read_table(path, memory_map=True)
+    return table.to_pandas()
+
+
+def write_clean_data(data_path:str=DATA_PATH, output_path:str='data/cleaned.csv', chunksize:int=CHUNKSIZE) -> int:
+    """ Clean the raw csv chunk by chunk and append each clean chunk to the output file
+        (csv, Parquet or Arrow IPC depending on its extension).
+        Returns the number of rows written.
+    """
+    n_rows = 0
+    with _CleanDataWriter(output_path) as writer:
+        for chunk in iter_clean_data(data_path, chunksize=chunksize):
+            writer.write(chunk)
+            n_rows += len(chunk)
+    return n_rows
+
+
+def _read_stamp(output_path:str):
+    """ Raw file an output was cleaned from, as written by clean_file, or None when there is none"""
+    stamp_path = output_path + '.source'
+    if not (os.path.exists(output_path) and os.path.exists(stamp_path)):
+        return None
+    try:
+        with open(stamp_path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def clean_file(data_path:str, output_paths:list=('data/cleaned.csv',), chunksize:int=CHUNKSIZE) -> dict:
+    """ Clean a raw csv into every output which is not up to date (csv, Parquet or Arrow, see write_clean_data),
+        cleaning it once whatever the number of outputs.
+        Each output gets a .source file next to it with the size, modification time and hash of the raw file and the
+        cleaning_version it was cleaned from: when nothing changed, nothing is written and pandas is not even imported.
+        The raw file is only hashed when its size or modification time changed, as in project_raw_data; when its
+        content did not change, only the .source files are updated.
+        Returns the input, its size in bytes, the rows cleaned (0 when every output was up to date),
+        the seconds taken and the outputs written.
+    """
+    start = time.perf_counter()
+    stat = os.stat(data_path)
+    stamp = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': None, 'version': cleaning_version()}
+    stale, touched = [], []
+    for output_path in output_paths:
+        previous = _read_stamp(output_path)
+        if previous is None or previous.get('version') != stamp['version']:
+            stale.append(output_path)
+        elif (previous.get('size'), previous.get('mtime_ns')) != (stamp['size'], stamp['mtime_ns']):
+            # Hashed once whatever the number of outputs
+            stamp['hash'] = stamp['hash'] or file_hash(data_path)
+            (touched if previous.get('hash') == stamp['hash'] else stale).append(output_path)
+    n_rows = 0
+    if stale:
+        stamp['hash'] = stamp['hash'] or file_hash(data_path)
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(_CleanDataWriter(output_path)) for output_path in stale]
+            for chunk in iter_clean_data(data_path, chunksize=chunksize):
+                for writer in writers:
+                    writer.write(chunk)
+                n_rows += len(chunk)
+    for output_path in stale + touched:
+        with open(output_path + '.source', 'w') as f:
+            json.dump(stamp, f)
+    return {'input': data_path, 'bytes': os.path.getsize(data_path), 'rows': n_rows,
+            'seconds': time.perf_counter() - start, 'written': stale}
+
+
+def clean_files(tasks:list, jobs:int=1, chunksize:int=CHUNKSIZE):
+    """ clean_file on every (data_path, output_paths) task, jobs files at once in separate processes.
+        Yields (data_path, result) as the files are done, the result being the exception raised
+        when a file could not be cleaned: one bad export does not stop the others.
+    """
+    def outcome(call, *args):
+        try:
+            return call(*args)
+        except Exception as e:
+            return e
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for data_path, output_paths in tasks:
+            yield data_path, outcome(clean_file, data_path, output_paths, chunksize)
+        return
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        futures = {executor.submit(clean_file, data_path, output_paths, chunksize): data_path
+                   for data_path, output_paths in tasks}
+        for future in as_completed(futures):
+            yield futures[future], outcome(future.result)
+
+
+def output_paths_for(data_path:str, output_dir:str, formats:list=('csv',)) -> list:
+    """ Clean files of a raw file in the output directory, one per format: <name>_cleaned.<format>"""
+    stem = os.path.splitext(os.path.basename(data_path))[0]
+    return [os.path.join(output_dir, f'{stem}_cleaned.{file_format}') for file_format in formats]
+
+
+def _expand_inputs(patterns:list) -> list:
+    """ Files matching the paths or glob patterns, in order and without duplicates"""
+    import glob
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        matches = [path for path in matches if os.path.isfile(path)]
+        if not matches:
+            raise FileNotFoundError(f"No raw file matches {pattern!r}")
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def print_summary(results:list, seconds:float, file=None) -> None:
+    """ Throughput of each cleaned file, and of the whole run which took seconds (files are cleaned concurrently)"""
+    names = [result['input'] if result['written'] else f"{result['input']} (up to date)" for result in results]
+    width = max(map(len, names + ['total']))
+
+    def line(name, n_rows, n_bytes, seconds):
+        rows_rate, bytes_rate = (f'{n / seconds:12,.0f}' if seconds else f'{"-":>12}' for n in (n_rows, n_bytes))
+        print(f'{name:<{width}} {n_rows:>10,} {n_bytes / 1e6:>10.1f} {seconds:>8.2f} {rows_rate} {bytes_rate}', file=file)
+
+    print(f'{"file":<{width}} {"rows":>10} {"MB":>10} {"seconds":>8} {"rows/s":>12} {"bytes/s":>12}', file=file)
+    for name, result in zip(names, results):
+        line(name, result['rows'], result['bytes'], result['seconds'])
+    if len(results) > 1:
+        line('total', sum(result['rows'] for result in results), sum(result['bytes'] for result in results), seconds)
+
+
+def main(argv:list=None) -> int:
+    """ Command line: clean raw exports into an output directory, several files at once, and print the throughput
+        of each file. Without inputs, the Montpellier export is downloaded if needed and cleaned into data/cleaned.csv,
+        and data/cleaned.parquet when pyarrow is installed.
+        Returns the exit status, 1 when a file could not be cleaned.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Clean raw AED exports")
+    parser.add_argument('inputs', nargs='*', help="raw csv files or glob patterns (quoted, e.g. 'exports/*.csv')")
+    parser.add_argument('-o', '--output-dir', default='data', help="directory of the clean files <name>_cleaned.<format>")
+    parser.add_argument('-f', '--format', dest='formats', nargs='+', default=['csv'],
+                        choices=sorted({extension[1:] for extension in CLEAN_FORMATS}),
+                        help="formats of the clean files, one file per format")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="number of files cleaned at once")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help="rows cleaned at once in each file")
+    args = parser.parse_args(argv)
+
+    if args.inputs:
+        try:
+            inputs = _expand_inputs(args.inputs)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+        tasks = [(data_path, output_paths_for(data_path, args.output_dir, args.formats)) for data_path in inputs]
+        outputs = [output_path for _, output_paths in tasks for output_path in output_paths]
+        if len(set(outputs)) < len(outputs):
+            parser.error("several inputs have the same file name, their clean files would overwrite each other")
+        os.makedirs(args.output_dir, exist_ok=True)
+    else:
+        output_paths = ['data/cleaned.csv']
+        # Typed columnar copy for consumers that should not re-parse the csv
+        if importlib.util.find_spec('pyarrow') is not None:
+            output_paths.append('data/cleaned.parquet')
+        tasks = [(download_data(), output_paths)]
+
+    start = time.perf_counter()
+    results = dict(clean_files(tasks, jobs=args.jobs or 1, chunksize=args.chunksize))
+    seconds = time.perf_counter() - start
+    failed = {data_path: e for data_path, e in results.items() if isinstance(e, Exception)}
+    for data_path, e in failed.items():
+        print(f"{data_path}: {type(e).__name__}: {e}", file=sys.stderr)
+    print_summary([results[data_path] for data_path, _ in tasks if data_path not in failed], seconds)
+    return 1 if failed else 0
+
+
 # if the module is called, run the main loading function
 if __name__ == '__main__':
-    cleaned_df = load_clean_data(download_data())
-    cleaned_df.to_csv('data/cleaned.csv', index=False)
\ No newline at end of file
+    sys.exit(main())
@@ -1,3 +1,11 @@
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 import numpy as np
 import pandas as pd
@@ -429,9 +437,81 @@ def test_load_formatted_data(sample_dirty_fname, sample_formatted):
     assert load_formatted_data(sample_dirty_fname).equals(sample_formatted)
 
 
-def test_sanitize_data(sample_formatted, sample_sanitized):
+@pytest.mark.parametrize('parser_engine', ['pyarrow', 'projected'])
+def test_load_formatted_data_pyarrow(sample_dirty_fname, sample_formatted, parser_engine, tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    import loader
+    from loader import DATA_PATH, QualityReport, load_formatted_data, load_clean_data, read_raw_data
+    monkeypatch.setattr(loader, 'PROJECTION_DIR', str(tmp_path / 'raw'))
+    assert load_formatted_data(sample_dirty_fname, parser_engine=parser_engine).equals(sample_formatted)
+    # Same null values as the c parser ('-' in the coordinates of the raw data): same frames and same counters
+    for data_fname in [sample_dirty_fname, DATA_PATH]:
+        expected, quality = QualityReport(), QualityReport()
+        clean_df = load_clean_data(data_fname, parser_engine=parser_engine, quality=quality)
+        assert clean_df.equals(load_clean_data(data_fname, quality=expected))
+        assert quality.report() == expected.report()
+    # The projected copies are written in PROJECTION_DIR as it is when they are read
+    assert (parser_engine == 'projected') == (tmp_path / 'raw').is_dir()
+    # Null values of pandas the pyarrow parser does not know by default
+    data_path = tmp_path / 'nulls.csv'
+    header = open(sample_dirty_fname).readline()
+    data_path.write_text(header + 'None,<NA>,avenue albert Einstein,34000,Montpellier,,tous les ans,2019-05-15,None,<NA>\n')
+    raw = read_raw_data(str(data_path), parser_engine=parser_engine)
+    assert raw[['nom', 'adr_num', 'tel1', 'lat_coor1', 'long_coor1']].isna().all(axis=None)
+    assert raw.equals(read_raw_data(str(data_path)))
+
+
+def test_projected_raw_data(sample_dirty_fname, sample_formatted, sample_framed, tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    import os
+    from loader import iter_clean_data, load_formatted_data, project_raw_data, read_raw_data
+    data_path = tmp_path / 'raw.csv'
+    data_path.write_bytes(open(sample_dirty_fname, 'rb').read())
+    last_line = open(sample_dirty_fname).read().splitlines()[-1]
+    monkeypatch.chdir(tmp_path)
+    assert load_formatted_data('raw.csv', parser_engine='projected').equals(sample_formatted)
+    # The copy is written once, without the unused columns
+    projection_path = project_raw_data('raw.csv')
+    modified = os.path.getmtime(projection_path)
+    assert load_formatted_data('raw.csv', parser_engine='projected').equals(sample_formatted)
+    assert os.path.getmtime(projection_path) == modified
+    # By chunks
+    chunks = list(iter_clean_data('raw.csv', chunksize=4, parser_engine='projected'))
+    assert pd.concat(chunks).equals(sample_framed)
+    # A new version of the raw file replaces the copy of the previous one
+    with open(data_path, 'a') as f:
+        f.write(last_line + '\n')
+    os.utime(data_path, ns=(os.stat(data_path).st_mtime_ns + 10**9,) * 2)
+    assert len(read_raw_data('raw.csv', parser_engine='projected')) == len(sample_formatted) + 1
+    assert not os.path.exists(projection_path) and len(os.listdir(tmp_path / 'data' / '.cache' / 'raw')) == 1
+
+    # Only the pertinent and key columns of a full export are kept
+    from benchmark import generate_dirty_data
+    generate_dirty_data(100, 'export.csv')
+    assert list(pd.read_feather(project_raw_data('export.csv')).columns) == [
+        'nom', 'lat_coor1', 'long_coor1', 'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt', 'dermnt', 'ref', 'id']
+    pd.testing.assert_frame_equal(load_formatted_data('export.csv', parser_engine='projected'), load_formatted_data('export.csv'))
+    pd.testing.assert_frame_equal(read_raw_data('export.csv', parser_engine='projected', extra_columns=['id']),
+                                  read_raw_data('export.csv', extra_columns=['id']))
+
+
+@pytest.mark.parametrize('engine', ['unique', 'vectorized', 'loop'])
+def test_sanitize_data(sample_formatted, sample_sanitized, engine):
+    from loader import sanitize_data
+    assert sanitize_data(sample_formatted, engine=engine).equals(sample_sanitized)
+
+
+def test_sanitize_data_engines_match_on_raw_data():
+    from loader import DATA_PATH, load_formatted_data, sanitize_data
+    unique = sanitize_data(load_formatted_data(DATA_PATH), engine='unique')
+    loop = sanitize_data(load_formatted_data(DATA_PATH), engine='loop')
+    pd.testing.assert_frame_equal(unique, loop)
+
+
+def test_sanitize_data_unknown_engine(sample_formatted):
     from loader import sanitize_data
-    assert sanitize_data(sample_formatted).equals(sample_sanitized)
+    with pytest.raises(ValueError):
+        sanitize_data(sample_formatted, engine='unknown')
 
 
 def test_frame_data(sample_sanitized, sample_framed):
@@ -446,4 +526,474 @@ def test_load_clean_data(sample_dirty_fname, sample_framed):
 
 def assert_column_equal(clean, target, column):
     # utility function if you which to implement column-specific assertion tests
-    assert clean[column].equals(target[column]), f"Result should be {clean[column]} but was {target[column]}"
\ No newline at end of file
+    assert clean[column].equals(target[column]), f"Result should be {clean[column]} but was {target[column]}"
+
+def test_iter_clean_data(sample_dirty_fname, sample_framed):
+    from loader import iter_clean_data
+    chunks = list(iter_clean_data(sample_dirty_fname, chunksize=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 4, 2]
+    assert pd.concat(chunks).equals(sample_framed)
+
+
+def test_write_clean_data(sample_dirty_fname, sample_framed, tmp_path):
+    from loader import write_clean_data
+    output_path = tmp_path / 'cleaned.csv'
+    assert write_clean_data(sample_dirty_fname, output_path, chunksize=5) == len(sample_framed)
+    expected_path = tmp_path / 'expected.csv'
+    sample_framed.to_csv(expected_path, index=False)
+    assert output_path.read_text() == expected_path.read_text()
+
+
+def test_load_clean_data_workers(sample_dirty_fname, sample_framed):
+    from loader import load_clean_data
+    assert load_clean_data(sample_dirty_fname, workers=3).equals(sample_framed)
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow', '.feather'])
+def test_columnar_round_trip(sample_dirty_fname, sample_framed, tmp_path, extension):
+    pytest.importorskip('pyarrow')
+    from loader import load_clean_data, save_clean_data, write_clean_data
+    saved_path = tmp_path / f'saved{extension}'
+    save_clean_data(sample_framed, saved_path)
+    assert load_clean_data(saved_path).equals(sample_framed)
+    streamed_path = tmp_path / f'streamed{extension}'
+    write_clean_data(sample_dirty_fname, streamed_path, chunksize=4)
+    assert load_clean_data(streamed_path).equals(sample_framed)
+
+
+def test_compact_clean_data(sample_dirty_fname, sample_framed, tmp_path):
+    from loader import compact_clean_data, format_phone_numbers, load_clean_data, save_clean_data
+    memory = {}
+    compact = compact_clean_data(sample_framed, memory)
+    assert compact['Maintenance frequency'].dtype == 'category'
+    assert compact['Phone number'].dtype == 'UInt32'
+    assert compact['Latitude'].dtype == 'float32'
+    assert sum(column['bytes_after'] for column in memory.values()) < sum(column['bytes_before'] for column in memory.values())
+    # Same values
+    pd.testing.assert_series_equal(format_phone_numbers(compact['Phone number']), sample_framed['Phone number'])
+    pd.testing.assert_series_equal(compact['Maintenance frequency'].astype('string'), sample_framed['Maintenance frequency'])
+    pd.testing.assert_series_equal(compact['Name'].astype('string[python]'), sample_framed['Name'])
+    np.testing.assert_allclose(compact['Latitude'], sample_framed['Latitude'], atol=1e-5)
+    pd.testing.assert_frame_equal(load_clean_data(sample_dirty_fname, compact=True), compact)
+    # Written as the full frame
+    save_clean_data(compact, tmp_path / 'compact.csv')
+    save_clean_data(sample_framed, tmp_path / 'full.csv')
+    assert open(tmp_path / 'compact.csv').read().count('+33') == open(tmp_path / 'full.csv').read().count('+33') > 0
+    # Phone numbers in another format are kept as strings
+    other = sample_framed.assign(**{'Phone number': sample_framed['Phone number'].str.replace('+33 ', '0', regex=False)})
+    assert compact_clean_data(other)['Phone number'].dtype != 'UInt32'
+
+
+def test_clean_data_cache(sample_dirty_fname, sample_framed, tmp_path):
+    from loader import CleanDataCache, load_clean_data
+    cache = CleanDataCache(tmp_path / 'cache')
+    assert load_clean_data(sample_dirty_fname, cache=cache).equals(sample_framed)
+    assert load_clean_data(sample_dirty_fname, cache=cache).equals(sample_framed)
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1 and cache.stats()['entries'] == 1
+    assert cache.invalidate(sample_dirty_fname) == 1
+    assert cache.get(sample_dirty_fname) is None
+
+
+def test_clean_data_cache_eviction(sample_dirty_fname, tmp_path):
+    from loader import CleanDataCache
+    other_fname = tmp_path / 'other.csv'
+    other_fname.write_text(open(sample_dirty_fname).read() + '\n')
+    cache = CleanDataCache(tmp_path / 'cache', max_bytes=1)
+    cache.load(sample_dirty_fname)
+    cache.load(other_fname)
+    # Only the most recent entry is kept when the cache is over its size
+    assert cache.stats()['entries'] == 1
+    assert cache.get(other_fname) is not None
+
+
+def test_update_clean_data_next_to_cache(sample_dirty_fname, tmp_path, monkeypatch):
+    from loader import INCREMENTAL_STATE_PATH, CleanDataCache, update_clean_data
+    data_fname = tmp_path / 'raw.csv'
+    data_fname.write_bytes(open(sample_dirty_fname, 'rb').read())
+    monkeypatch.chdir(tmp_path)
+    # Both under their default paths: the incremental state is not a cache entry
+    update_clean_data('raw.csv')
+    cache = CleanDataCache()
+    cache.load('raw.csv')
+    assert cache.stats()['entries'] == 1
+    assert cache.invalidate() == 1
+    assert os.path.exists(INCREMENTAL_STATE_PATH)
+    assert update_clean_data('raw.csv')[1]['unchanged'] == 14
+
+
+def test_update_clean_data(sample_dirty_fname, sample_framed, tmp_path):
+    from loader import load_clean_data, update_clean_data
+    state_path = tmp_path / 'state.pkl'
+    clean_df, changes = update_clean_data(sample_dirty_fname, state_path)
+    assert clean_df.equals(sample_framed)
+    assert changes == {'added': 14, 'modified': 0, 'unchanged': 0, 'removed': 0}
+
+    # New publication: one row rewritten, one row removed
+    lines = open(sample_dirty_fname).read().splitlines()
+    lines[3] = lines[3].replace('rue Jacques-Bounin', 'rue Jacques Bounin')
+    del lines[5]
+    new_fname = tmp_path / 'new.csv'
+    new_fname.write_text('\n'.join(lines) + '\n')
+    clean_df, changes = update_clean_data(new_fname, state_path)
+    assert changes['unchanged'] == 12 and changes['added'] == 1
+    assert clean_df.equals(load_clean_data(new_fname))
+
+
+class FileServer(ThreadingHTTPServer):
+    """ Local stand-in for the open data portal: serves in-memory files with ETag and Range support"""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileRequestHandler)
+        self.files = {}
+        self.requests = []
+        # Number of bytes after which the next full response is cut, to simulate an interrupted download
+        self.cut_after = None
+        # Number of next requests of each file answered with a 503, and seconds each response is delayed by
+        self.failures = {}
+        self.delay = 0
+        # Most requests served at once
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.server_address[1]}/{name}'
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self._get()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def _get(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        name = self.path.lstrip('/').split('?')[0]
+        with self.server.lock:
+            failing = self.server.failures.get(name, 0) > 0
+            self.server.failures[name] = self.server.failures.get(name, 0) - failing
+        if failing:
+            self.send_error(503)
+            return
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+        body, content_type = self.server.files[name]
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if self.server.cut_after is not None:
+            self.wfile.write(body[start:start + self.server.cut_after])
+            self.server.cut_after = None
+            self.close_connection = True
+        else:
+            self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_data_resume_and_conditional(file_server, sample_dirty_fname, tmp_path, monkeypatch):
+    import requests
+    from loader import download_data
+    header, rows = open(sample_dirty_fname, 'rb').read().split(b'\n', 1)
+    body = header + b'\n' + rows * 200
+    file_server.files['sample.csv'] = (body, 'text/csv; charset=utf-8')
+    monkeypatch.chdir(tmp_path)
+
+    # Interrupted download, then resumed from where it stopped
+    file_server.cut_after = len(body) // 2
+    with pytest.raises(requests.exceptions.RequestException):
+        download_data(file_server.url('sample.csv'))
+    downloaded = (tmp_path / 'data' / 'sample.csv.part').stat().st_size
+    assert downloaded > 0
+    assert download_data(file_server.url('sample.csv')) == 'data/sample.csv'
+    assert file_server.requests[-1][1]['Range'] == f'bytes={downloaded}-'
+    assert open('data/sample.csv', 'rb').read() == body
+
+    # Unchanged remote file: nothing downloaded again
+    download_data(file_server.url('sample.csv'), force_download=True)
+    assert 'If-None-Match' in file_server.requests[-1][1]
+    assert open('data/sample.csv', 'rb').read() == body
+
+
+def test_download_data_encoding(file_server, tmp_path, monkeypatch):
+    from loader import download_data
+    text = 'nom,com_nom\nMédiathèque,Montpellier\n'
+    file_server.files['declared.csv'] = (text.encode('latin-1'), 'text/csv; charset=ISO-8859-1')
+    file_server.files['explicit.csv'] = (text.encode('cp1252'), 'text/csv')
+    monkeypatch.chdir(tmp_path)
+    assert open(download_data(file_server.url('declared.csv')), encoding='utf-8').read() == text
+    assert open(download_data(file_server.url('explicit.csv'), encoding='cp1252'), encoding='utf-8').read() == text
+
+
+def test_fetch_all(file_server, tmp_path, monkeypatch):
+    import os
+    import requests
+    from loader import download_all
+    names = sorted(name for name in os.listdir('data') if name.endswith('.csv'))
+    for name in names:
+        file_server.files[name] = (open(os.path.join('data', name), 'rb').read(), 'text/csv; charset=utf-8')
+    file_server.delay = 0.05
+    file_server.failures[names[0]] = 2
+    monkeypatch.chdir(tmp_path)
+    urls = [file_server.url(name) for name in names] + [file_server.url('missing.csv')]
+    results = download_all(urls, max_per_host=2, backoff=0.01)
+    for name in names:
+        assert results[file_server.url(name)] == os.path.join('data', name)
+        assert (tmp_path / 'data' / name).read_bytes() == file_server.files[name][0]
+    assert sum(path.endswith(names[0]) for path, _ in file_server.requests) == 3
+    # 404 is not retried
+    assert isinstance(results[file_server.url('missing.csv')], requests.HTTPError)
+    assert sum(path.endswith('missing.csv') for path, _ in file_server.requests) == 1
+    assert file_server.max_active <= 2
+    # Two URLs for the same data file
+    with pytest.raises(ValueError):
+        download_all([file_server.url(names[0]), file_server.url(names[0]) + '?v=2'])
+
+
+def test_sanitize_data_stats(sample_formatted, sample_sanitized):
+    from loader import sanitize_data
+    stats = {}
+    assert sanitize_data(sample_formatted, stats=stats).equals(sample_sanitized)
+    assert set(stats) == {'adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1', 'freq_mnt'}
+    # 12 non null cities, written 2 different ways
+    assert stats['com_nom'] == {'rows': 14, 'values': 12, 'unique': 2, 'hit_ratio': 1 - 2 / 12}
+
+
+def test_quality_report(sample_dirty_fname, sample_formatted, sample_sanitized, sample_framed, tmp_path):
+    from loader import QualityReport, iter_clean_data, load_clean_data, read_raw_data
+    quality = QualityReport()
+    pd.testing.assert_frame_equal(load_clean_data(sample_dirty_fname, quality=quality), sample_framed)
+    report = quality.report()
+    assert report['rows'] == len(sample_framed)
+    raw = read_raw_data(sample_dirty_fname)
+    for column in ['adr_num', 'adr_voie', 'com_cp', 'com_nom', 'tel1']:
+        counters = report['columns'][column]
+        before, after = sample_formatted[column], sample_sanitized[column]
+        assert counters['missing'] == raw[column].isna().sum()
+        assert counters['nulls_introduced'] == (before.notna() & after.isna()).sum()
+        assert counters['rewritten'] == (before.notna() & after.notna() & (before != after).fillna(False)).sum()
+    assert report['columns']['com_cp']['rules'] == {'zero': report['columns']['com_cp']['nulls_introduced']}
+    assert report['columns']['dermnt']['parse_failures'] == (raw['dermnt'].notna() & sample_formatted['dermnt'].isna()).sum()
+    assert report['columns']['freq_mnt']['missing'] == raw['freq_mnt'].isna().sum()
+
+    # Same counters when the file is cleaned chunk by chunk, or by several processes
+    streamed = QualityReport()
+    for _ in iter_clean_data(sample_dirty_fname, chunksize=4, quality=streamed):
+        pass
+    assert streamed.report() == report
+    parallel = QualityReport()
+    load_clean_data(sample_dirty_fname, workers=2, quality=parallel)
+    assert parallel.report() == report
+    quality.to_json(tmp_path / 'quality.json')
+
+
+def test_quality_report_stages(sample_dirty_fname, sample_formatted, sample_sanitized):
+    from loader import QualityReport, load_formatted_data, read_raw_data, sanitize_data
+    raw = read_raw_data(sample_dirty_fname)
+    freq_dates = raw['freq_mnt'].notna() & sample_formatted['freq_mnt'].isna()
+    # Each stage alone gets counters of its own
+    formatting = QualityReport()
+    load_formatted_data(sample_dirty_fname, quality=formatting)
+    report = formatting.report()
+    assert report['rows'] == len(raw) and report['stages'] == {'format_data': len(raw)}
+    for column, counters in report['columns'].items():
+        assert counters['missing'] == raw[column].isna().sum()
+    assert report['columns']['freq_mnt']['nulls_introduced'] == report['columns']['freq_mnt']['rules']['date'] == freq_dates.sum() > 0
+    assert all(counters['rewritten'] == 0 for counters in report['columns'].values())
+
+    sanitizing = QualityReport()
+    sanitize_data(sample_formatted.copy(), quality=sanitizing)
+    report = sanitizing.report()
+    assert report['rows'] == len(raw) and report['stages'] == {'sanitize_data': len(raw)}
+    for column, counters in report['columns'].items():
+        before, after = sample_formatted[column], sample_sanitized[column]
+        assert counters['missing'] == counters['parse_failures'] == 0
+        assert counters['nulls_introduced'] == (before.notna() & after.isna()).sum()
+
+    # Both stages make the counters of the whole pipeline
+    pipeline = QualityReport()
+    sanitize_data(load_formatted_data(sample_dirty_fname, quality=pipeline), quality=pipeline)
+    assert pipeline.rows == len(raw)
+    assert pipeline.report()['columns'] == formatting.merge(sanitizing).report()['columns']
+
+
+def test_pipeline_profile(sample_dirty_fname, sample_framed, tmp_path):
+    import json
+    from loader import PipelineProfile, load_clean_data
+    profile = PipelineProfile()
+    assert load_clean_data(sample_dirty_fname, profile=profile).equals(sample_framed)
+    report = profile.report()
+    assert [record['stage'] for record in report] == [
+        'load_formatted_data',
+        'sanitize_data.adr_num', 'sanitize_data.adr_voie', 'sanitize_data.com_cp',
+        'sanitize_data.com_nom', 'sanitize_data.tel1', 'sanitize_data.freq_mnt',
+        'sanitize_data', 'frame_data', 'load_clean_data']
+    assert all(record['rows'] == 14 and record['seconds'] >= 0 and record['peak_bytes'] >= 0 for record in report)
+    # The whole pipeline holds at least as much memory as any of its stages
+    assert report[-1]['peak_bytes'] >= max(record['peak_bytes'] for record in report)
+    profile.to_json(tmp_path / 'profile.json')
+    assert json.loads((tmp_path / 'profile.json').read_text()) == report
+
+
+def test_pipeline_profile_nested_peak():
+    from loader import PipelineProfile
+    profile = PipelineProfile()
+    # Memory allocated and freed by a stage before a nested stage starts still counts for it
+    with profile.stage('outer'):
+        block = bytearray(50_000_000)
+        del block
+        with profile.stage('inner'):
+            pass
+    inner, outer = profile.report()
+    assert inner['peak_bytes'] < 1_000_000
+    assert outer['peak_bytes'] >= 50_000_000
+
+
+def test_register_rule(sample_formatted, sample_sanitized, monkeypatch):
+    import loader
+    monkeypatch.setattr(loader, 'SANITIZING_RULES', list(loader.SANITIZING_RULES))
+    # Region-specific rule, running after the built-in street rules
+    loader.register_rule('adr_voie', 100, when=r'^rue ', pattern=r'^rue ', replacement='Rue ')
+    assert [rule.order for rule in loader.column_rules()['adr_voie']] == [10, 20, 30, 40, 50, 60, 100]
+    sanitized = loader.sanitize_data(sample_formatted)
+    expected = sample_sanitized['adr_voie'].str.replace(r'^rue ', 'Rue ', regex=True)
+    assert sanitized['adr_voie'].equals(expected)
+    assert sanitized.drop(columns='adr_voie').equals(sample_sanitized.drop(columns='adr_voie'))
+
+
+def test_register_rule_invalidates_results(sample_dirty_fname, tmp_path, monkeypatch):
+    import loader
+    monkeypatch.setattr(loader, 'SANITIZING_RULES', list(loader.SANITIZING_RULES))
+    cache = loader.CleanDataCache(tmp_path / 'cache')
+    state_path = tmp_path / 'state.pkl'
+    output_path = str(tmp_path / 'cleaned.csv')
+    before = loader.cleaning_version()
+    cache.load(sample_dirty_fname)
+    loader.update_clean_data(sample_dirty_fname, state_path)
+    loader.clean_file(sample_dirty_fname, [output_path])
+
+    loader.register_rule('adr_voie', 100, when=r'^rue ', pattern=r'^rue ', replacement='Rue ')
+    assert loader.cleaning_version() != before
+    expected = loader.load_clean_data(sample_dirty_fname)
+    assert expected['Address'].str.contains(' Rue ').any()
+    # Nothing cleaned with the previous rules is reused
+    assert cache.load(sample_dirty_fname).equals(expected)
+    clean_df, changes = loader.update_clean_data(sample_dirty_fname, state_path)
+    assert clean_df.equals(expected) and changes['unchanged'] == 0
+    assert loader.clean_file(sample_dirty_fname, [output_path])['written'] == [output_path]
+
+
+def test_import_is_light():
+    # The modules imported, rather than the time taken, which depends on the machine
+    code = "import sys; before = set(sys.modules); import loader; print(*sorted(set(sys.modules) - before))"
+    imported = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split()
+    packages = {name.split('.')[0] for name in imported} - set(sys.stdlib_module_names) - {'loader'}
+    # pandas and numpy are only registered, to be executed on first use
+    assert packages <= {'pandas', 'numpy'}
+    assert not [name for name in imported if name.startswith(('pandas.', 'numpy.'))]
+
+
+def test_clean_file(sample_dirty_fname, sample_framed, tmp_path, monkeypatch):
+    import loader
+    from loader import clean_file
+    data_path = tmp_path / 'raw.csv'
+    data_path.write_bytes(open(sample_dirty_fname, 'rb').read())
+    output_path = str(tmp_path / 'cleaned.csv')
+    result = clean_file(str(data_path), [output_path])
+    assert result['written'] == [output_path] and result['rows'] == len(sample_framed)
+    # Up to date: nothing is written again
+    assert clean_file(str(data_path), [output_path])['written'] == []
+    assert len(pd.read_csv(output_path)) == len(sample_framed)
+    # Same size and modification time: the raw file is not even hashed
+    monkeypatch.setattr(loader, 'file_hash', None)
+    assert clean_file(str(data_path), [output_path])['written'] == []
+    monkeypatch.undo()
+    # Touched but not modified: hashed, and not cleaned again
+    os.utime(data_path, ns=(0, 0))
+    assert clean_file(str(data_path), [output_path])['written'] == []
+    monkeypatch.setattr(loader, 'file_hash', None)
+    assert clean_file(str(data_path), [output_path])['written'] == []
+    monkeypatch.undo()
+    # The raw file changed
+    with open(data_path, 'a') as f:
+        f.write(open(sample_dirty_fname).read().splitlines()[-1] + '\n')
+    assert clean_file(str(data_path), [output_path])['written'] == [output_path]
+    assert len(pd.read_csv(output_path)) == len(sample_framed) + 1
+
+
+@pytest.mark.parametrize('extension', ['csv', 'parquet'])
+def test_clean_file_interrupted(extension, sample_dirty_fname, sample_framed, tmp_path, monkeypatch):
+    import loader
+    if extension != 'csv':
+        pytest.importorskip('pyarrow')
+    data_path = tmp_path / 'raw.csv'
+    data_path.write_bytes(open(sample_dirty_fname, 'rb').read())
+    output_path = str(tmp_path / f'cleaned.{extension}')
+    loader.clean_file(str(data_path), [output_path])
+    with open(data_path, 'a') as f:
+        f.write(open(sample_dirty_fname).read().splitlines()[-1] + '\n')
+
+    def interrupted(*args, **kwargs):
+        yield sample_framed.iloc[:4]
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(loader, 'iter_clean_data', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        loader.clean_file(str(data_path), [output_path], chunksize=4)
+    # The previous output is left as it was, and is still seen as stale
+    assert not os.path.exists(output_path + '.tmp')
+    monkeypatch.undo()
+    read = pd.read_csv if extension == 'csv' else pd.read_parquet
+    assert len(read(output_path)) == len(sample_framed)
+    assert loader.clean_file(str(data_path), [output_path])['written'] == [output_path]
+    assert len(read(output_path)) == len(sample_framed) + 1
+
+
+def test_main(sample_dirty_fname, sample_framed, tmp_path, capsys):
+    from loader import main
+    for name in ('lyon.csv', 'nice.csv'):
+        (tmp_path / name).write_bytes(open(sample_dirty_fname, 'rb').read())
+    (tmp_path / 'broken.csv').write_text('not,an,export\n')
+    output_dir = tmp_path / 'clean'
+    assert main([str(tmp_path / '*.csv'), '-o', str(output_dir), '-j', '2']) == 1
+    out, err = capsys.readouterr()
+    assert 'broken.csv' in err
+    assert [line.split()[0] for line in out.splitlines()[1:]] == [str(tmp_path / 'lyon.csv'), str(tmp_path / 'nice.csv'), 'total']
+    for name in ('lyon', 'nice'):
+        assert len(pd.read_csv(output_dir / f'{name}_cleaned.csv')) == len(sample_framed)
+    assert main([str(tmp_path / 'lyon.csv'), '-o', str(output_dir)]) == 0
+    assert '(up to date)' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'missing.csv')])
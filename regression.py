@@ -0,0 +1,253 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import benchmark
+import loader
+
+# Differential regression harness: every fast engine of the pipeline is run against a reference implementation,
+# on the same input, and the first row and column where they disagree is reported.
+# The reference is the plain row by row version of each stage: each raw value is read and formatted on its own,
+# sanitized by the legacy row loop (sanitize_data(engine='loop')) and merged into the address one row
+# at a time.
+# It is slow (a few hundred rows per second for the sanitizing loop), reference_jobs spreads it over processes.
+DEFAULT_SIZES = [2_000]
+REFERENCE_BLOCK_SIZE = 5_000
+# Null values of the raw export, kept apart from the ones of loader so that a change there is caught
+REFERENCE_NA_VALUES = [' ']
+REFERENCE_COLUMN_NA_VALUES = {'lat_coor1': ['-'], 'long_coor1': ['-']}
+
+
+def read_reference_raw_data(data_fname:str) -> pd.DataFrame:
+    """ Pertinent columns of the raw csv as plain Python strings, with the default null values of pandas only"""
+    columns = [column for column in loader._raw_header(data_fname) if column in loader.RAW_COLUMNS]
+    return pd.read_csv(data_fname, usecols=columns, dtype=object, encoding='utf-8')[columns]
+
+
+def _reference_text(value, na_values:list):
+    return pd.NA if pd.isna(value) or value in na_values else value
+
+
+def _reference_date(value, **kwargs):
+    return pd.NaT if pd.isna(value) else pd.to_datetime(value, errors='coerce', **kwargs)
+
+
+def _reference_number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def reference_format_data(raw:pd.DataFrame) -> pd.DataFrame:
+    """ format_data one value at a time"""
+    columns = {column: [] for column in raw.columns}
+    for row in raw.itertuples(index=False):
+        for column, value in zip(raw.columns, row):
+            value = _reference_text(value, REFERENCE_NA_VALUES + REFERENCE_COLUMN_NA_VALUES.get(column, []))
+            if column == 'dermnt':
+                value = _reference_date(value, format='%Y-%m-%d')
+            elif column == 'freq_mnt' and pd.notna(_reference_date(value)):
+                # A date in the maintenance frequency is a misplaced value
+                value = pd.NA
+            elif column in loader.NUMERIC_COLUMNS:
+                value = _reference_number(value)
+            columns[column].append(value)
+    dtypes = {'dermnt': 'datetime64[ns]', **dict.fromkeys(loader.NUMERIC_COLUMNS, 'float64')}
+    return pd.DataFrame({column: pd.Series(values, dtype=dtypes.get(column, 'string'), index=raw.index)
+                         for column, values in columns.items()})
+
+
+def reference_frame_data(df:pd.DataFrame) -> pd.DataFrame:
+    """ frame_data one row at a time"""
+    addresses = []
+    for parts in df[loader.ADDRESS_COLUMNS].itertuples(index=False):
+        address = ' '.join(' '.join(part for part in parts if pd.notna(part)).split())
+        addresses.append(address or pd.NA)
+    framed = df.drop(columns=loader.ADDRESS_COLUMNS).rename(columns=loader.FRAMED_NAMES)
+    framed.insert(1, 'Address', pd.Series(addresses, dtype='string', index=df.index))
+    return framed
+
+
+def _timed(function, *args, clock=time.perf_counter, **kwargs):
+    start = clock()
+    result = function(*args, **kwargs)
+    return result, clock() - start
+
+
+def _reference_block(raw:pd.DataFrame) -> dict:
+    """ Every reference stage on a block of raw rows, with the CPU seconds each took
+        (the wall time of blocks run in parallel would count the time they wait for a processor)
+    """
+    # The legacy loop expects a 0-based index, the position in the file is restored afterwards
+    index = raw.index
+    formatted, formatting_time = _timed(reference_format_data, raw.reset_index(drop=True), clock=time.process_time)
+    sanitized, sanitizing_time = _timed(loader.sanitize_data, formatted.copy(), engine='loop', clock=time.process_time)
+    framed, framing_time = _timed(reference_frame_data, sanitized, clock=time.process_time)
+    for df in (formatted, sanitized, framed):
+        df.index = index
+    return {'load_formatted_data': (formatted, formatting_time), 'sanitize_data': (sanitized, sanitizing_time),
+            'frame_data': (framed, framing_time)}
+
+
+def reference_clean_data(data_path:str, jobs:int=1, block_size:int=REFERENCE_BLOCK_SIZE) -> dict:
+    """ Output of each reference stage on a raw csv, and its seconds, as {stage: (dataframe, seconds)}.
+        jobs: processes running the reference on blocks of block_size rows. The seconds are the CPU seconds summed
+              over the blocks, the time a single process would take, so that they stay comparable with the engines.
+    """
+    raw, reading_time = _timed(read_reference_raw_data, data_path)
+    blocks = [raw.iloc[i:i + block_size] for i in range(0, len(raw), block_size)] or [raw]
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_reference_block, blocks))
+    else:
+        results = [_reference_block(block) for block in blocks]
+    stages = {}
+    for stage in results[0]:
+        stages[stage] = (pd.concat([result[stage][0] for result in results]),
+                         sum(result[stage][1] for result in results))
+    # Reading is part of the formatting stage, as in load_formatted_data
+    formatted, formatting_time = stages['load_formatted_data']
+    stages['load_formatted_data'] = (formatted, formatting_time + reading_time)
+    return stages
+
+
+def _cell(value):
+    """ Diverging values as they are printed: a repr, with every kind of null shown the same way"""
+    return None if pd.isna(value) else repr(value.item() if isinstance(value, np.generic) else value)
+
+
+def first_divergence(expected:pd.DataFrame, actual:pd.DataFrame) -> dict:
+    """ Where actual first differs from expected, or None when they are the same frame.
+        Values are compared column by column as Python objects, every null value (None, NaN, NaT, pd.NA) being equal
+        to the others; the reported row is the first one with a diverging value, and its first diverging column.
+        Same values with different dtypes are reported once every value matches.
+    """
+    if list(expected.columns) != list(actual.columns):
+        return {'reason': 'columns', 'expected': list(expected.columns), 'actual': list(actual.columns)}
+    if len(expected) != len(actual):
+        return {'reason': 'rows', 'expected': len(expected), 'actual': len(actual)}
+    if not expected.index.equals(actual.index):
+        position = int(np.flatnonzero(expected.index.to_numpy() != actual.index.to_numpy())[0])
+        return {'reason': 'index', 'position': position,
+                'expected': _cell(expected.index[position]), 'actual': _cell(actual.index[position])}
+
+    diverging = {}
+    for column in expected.columns:
+        expected_values = expected[column].to_numpy(dtype=object)
+        actual_values = actual[column].to_numpy(dtype=object)
+        expected_na, actual_na = pd.isna(expected_values), pd.isna(actual_values)
+        both = ~(expected_na | actual_na)
+        different = expected_na != actual_na
+        different[both] = expected_values[both] != actual_values[both]
+        if different.any():
+            diverging[column] = different
+    if diverging:
+        rows = np.logical_or.reduce(list(diverging.values()))
+        position = int(np.flatnonzero(rows)[0])
+        column = next(column for column, different in diverging.items() if different[position])
+        return {'reason': 'value', 'row': expected.index[position], 'position': position, 'column': column,
+                'expected': _cell(expected[column].iat[position]), 'actual': _cell(actual[column].iat[position]),
+                'diverging_rows': int(rows.sum()), 'diverging_columns': list(diverging)}
+
+    for column in expected.columns:
+        if expected[column].dtype != actual[column].dtype:
+            return {'reason': 'dtype', 'column': column,
+                    'expected': str(expected[column].dtype), 'actual': str(actual[column].dtype)}
+    return None
+
+
+def _has_pyarrow() -> bool:
+    import importlib.util
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def stage_engines(pyarrow:bool=None) -> dict:
+    """ Engines checked against each reference stage, as {stage: {engine: function}}.
+        The functions of a stage take the output of the previous reference stage (the raw csv path for
+        load_formatted_data, and for load_clean_data whose reference is the whole reference pipeline),
+        so that a divergence is found in the stage causing it. The pyarrow engines need pyarrow.
+    """
+    pyarrow = _has_pyarrow() if pyarrow is None else pyarrow
+    engines = {
+        'load_formatted_data': {'c': loader.load_formatted_data},
+        'sanitize_data': {'unique': lambda df: loader.sanitize_data(df.copy())},
+        'frame_data': {'copy': loader.frame_data, 'inplace': lambda df: loader.frame_data(df.copy(), inplace=True)},
+        'load_clean_data': {'c': loader.load_clean_data,
+                            'workers': lambda path: loader.load_clean_data(path, workers=2),
+                            'chunks': lambda path: pd.concat(loader.iter_clean_data(path, chunksize=1_000))},
+    }
+    if pyarrow:
+        for stage in ('load_formatted_data', 'load_clean_data'):
+            for parser_engine in ('pyarrow', 'projected'):
+                engines[stage][parser_engine] = (lambda path, stage=stage, parser_engine=parser_engine:
+                                                 getattr(loader, stage)(path, parser_engine=parser_engine))
+    return engines
+
+
+def run_regression(data_path:str, engines:dict=None, reference_jobs:int=1) -> list:
+    """ Run every engine of every stage (see stage_engines) against the reference on a raw csv.
+        Returns one record per engine: its stage, the number of rows, the seconds of the reference and of the engine,
+        the speedup, and the first divergence (see first_divergence), None when the outputs are the same.
+    """
+    engines = stage_engines() if engines is None else engines
+    reference = reference_clean_data(data_path, reference_jobs)
+    inputs = {'load_formatted_data': data_path, 'sanitize_data': reference['load_formatted_data'][0],
+              'frame_data': reference['sanitize_data'][0], 'load_clean_data': data_path}
+    # The whole pipeline is compared with the whole reference pipeline
+    reference['load_clean_data'] = (reference['frame_data'][0], sum(seconds for _, seconds in reference.values()))
+
+    results = []
+    for stage, stage_functions in engines.items():
+        expected, reference_time = reference[stage]
+        for engine, function in stage_functions.items():
+            actual, engine_time = _timed(function, inputs[stage])
+            results.append({'input': data_path, 'stage': stage, 'engine': engine, 'rows': len(expected),
+                            'reference_seconds': reference_time, 'engine_seconds': engine_time,
+                            'speedup': reference_time / engine_time if engine_time else None,
+                            'divergence': first_divergence(expected, actual)})
+    return results
+
+
+def _describe(divergence:dict) -> str:
+    if divergence is None:
+        return 'same'
+    if divergence['reason'] == 'value':
+        return (f"row {divergence['row']} column {divergence['column']}: expected {divergence['expected']}, "
+                f"got {divergence['actual']} ({divergence['diverging_rows']} rows differ)")
+    where = f" {divergence['column']}" if 'column' in divergence else ''
+    return f"{divergence['reason']}{where}: expected {divergence['expected']}, got {divergence['actual']}"
+
+
+def print_results(results:list, file=None) -> None:
+    """ One line per engine, with its first divergence"""
+    table = pd.DataFrame(results)
+    table['divergence'] = table['divergence'].map(_describe)
+    print(table.to_string(index=False, float_format='{:.3f}'.format), file=file or sys.stdout)
+
+
+def main(argv:list=None) -> int:
+    """ Command line entry point, returns the exit status: 1 when an engine diverges from the reference"""
+    parser = argparse.ArgumentParser(description="Check the fast engines of the cleaning pipeline against the "
+                                                 "row by row reference, on real and synthetic dirty AED exports")
+    parser.add_argument('inputs', nargs='*', help=f"raw csv files to check (default: {loader.DATA_PATH}, when downloaded)")
+    parser.add_argument('--sizes', type=int, nargs='*', default=DEFAULT_SIZES,
+                        help="numbers of rows of the synthetic datasets also checked (see benchmark.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--reference-jobs', type=int, default=1, help="processes running the reference")
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or [path for path in [loader.DATA_PATH] if os.path.exists(path)]
+    inputs += [benchmark.dataset_path(n_rows, args.seed) for n_rows in args.sizes]
+    results = [result for path in inputs for result in run_regression(path, reference_jobs=args.reference_jobs)]
+    print_results(results)
+    return int(any(result['divergence'] is not None for result in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+SAMPLE_DIRTY_FNAME = 'data/sample_dirty.csv'
+
+
+def test_first_divergence():
+    from regression import first_divergence
+    expected = pd.DataFrame({'Name': pd.array(['a', None, 'c', 'd'], dtype='string'),
+                             'Latitude': [1.0, np.nan, 3.0, 4.0]}, index=[10, 11, 12, 13])
+    assert first_divergence(expected, expected.copy()) is None
+    # Every kind of null value is the same missing value
+    assert first_divergence(expected, expected.astype({'Name': object}).fillna({'Name': np.nan})) == {
+        'reason': 'dtype', 'column': 'Name', 'expected': 'string', 'actual': 'object'}
+
+    actual = expected.copy()
+    actual.loc[13, 'Name'] = 'D'
+    actual.loc[12, 'Latitude'] = np.nan
+    assert first_divergence(expected, actual) == {
+        'reason': 'value', 'row': 12, 'position': 2, 'column': 'Latitude', 'expected': '3.0', 'actual': None,
+        'diverging_rows': 2, 'diverging_columns': ['Name', 'Latitude']}
+    assert first_divergence(expected, actual.iloc[:3])['reason'] == 'rows'
+    assert first_divergence(expected, actual[['Latitude', 'Name']])['reason'] == 'columns'
+    assert first_divergence(expected, actual.reset_index(drop=True))['reason'] == 'index'
+
+
+@pytest.fixture
+def generated_fname(tmp_path):
+    from benchmark import generate_dirty_data
+    return str(generate_dirty_data(1_000, tmp_path / 'dirty.csv', seed=2))
+
+
+@pytest.mark.parametrize('data_fname', ['data/MMM_MMM_DAE.csv', 'generated'])
+def test_run_regression(data_fname, generated_fname, tmp_path, monkeypatch):
+    import loader
+    from regression import run_regression, stage_engines
+    if data_fname == 'generated':
+        data_fname = generated_fname
+    monkeypatch.setattr(loader, 'PROJECTION_DIR', str(tmp_path / 'raw'))
+    engines = stage_engines(pyarrow=False)
+    results = run_regression(data_fname, engines)
+    assert [(result['stage'], result['engine']) for result in results] == [
+        (stage, engine) for stage, functions in engines.items() for engine in functions]
+    assert all(result['divergence'] is None for result in results), results
+    assert all(result['reference_seconds'] > 0 and result['engine_seconds'] > 0 for result in results)
+
+
+def test_run_regression_pyarrow(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    import loader
+    from regression import run_regression, stage_engines
+    monkeypatch.setattr(loader, 'PROJECTION_DIR', str(tmp_path / 'raw'))
+    engines = {stage: {engine: function for engine, function in functions.items() if engine in ('pyarrow', 'projected')}
+               for stage, functions in stage_engines(pyarrow=True).items()}
+    results = run_regression(SAMPLE_DIRTY_FNAME, engines)
+    assert len(results) == 4 and all(result['divergence'] is None for result in results), results
+
+
+def test_run_regression_finds_divergence(tmp_path, monkeypatch):
+    import loader
+    from regression import main, run_regression
+    # main also checks the projected engines
+    monkeypatch.setattr(loader, 'PROJECTION_DIR', str(tmp_path / 'raw'))
+    # A fast engine forgetting a rule is caught, on its first row
+    monkeypatch.setattr(loader, 'SANITIZING_RULES', [rule for rule in loader.SANITIZING_RULES if rule.name != 'zero'])
+    engines = {'sanitize_data': {'unique': lambda df: loader.sanitize_data(df.copy())}}
+    [result] = run_regression(SAMPLE_DIRTY_FNAME, engines)
+    divergence = result['divergence']
+    assert (divergence['reason'], divergence['column']) == ('value', 'com_cp')
+    assert divergence['expected'] is None and divergence['actual'] == repr('0')
+    assert main([SAMPLE_DIRTY_FNAME, '--sizes']) == 1
+
+
+def test_run_regression_checks_null_values(monkeypatch):
+    import loader
+    from regression import run_regression
+    # The reference has its own null values: loader forgetting one is caught
+    monkeypatch.setattr(loader, 'NA_VALUES', [])
+    engines = {'load_formatted_data': {'c': loader.load_formatted_data}}
+    [result] = run_regression(SAMPLE_DIRTY_FNAME, engines)
+    divergence = result['divergence']
+    assert divergence['reason'] == 'value'
+    assert divergence['expected'] is None and divergence['actual'] == repr(' ')
@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import loader
+from spatial import COORDINATES_SWAPPED
+
+# Local query service: the clean dataframe is loaded once, kept in memory and queried over HTTP by every client,
+# instead of each process calling load_clean_data. The source file is polled every RELOAD_INTERVAL seconds,
+# a changed file is cleaned again in the background while the previous frame keeps being served.
+HOST = '127.0.0.1'
+PORT = 8000
+RELOAD_INTERVAL = 5.0
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# frame_data puts the postal code (com_cp) after the street, which may have numbers of 5 digits too: the last one
+POSTAL_CODE = re.compile(r'.*\b(\d{5})\b')
+# 'Tous les ans', 'Tous les 2 ans', 'tous les 6 mois'
+MAINTENANCE_PERIOD = re.compile(r'(?:(\d+)\s*)?\b(ans?|mois)\b', re.IGNORECASE)
+
+
+def maintenance_months(frequencies:pd.Series) -> pd.Series:
+    """ Months between two maintenances, from the maintenance frequency (NaN when it is unknown)"""
+    def months(frequency):
+        match = MAINTENANCE_PERIOD.search(frequency)
+        if match is None:
+            return np.nan
+        count = int(match.group(1) or 1)
+        return count if match.group(2).lower() == 'mois' else 12 * count
+
+    codes, uniques = pd.factorize(frequencies)
+    return pd.Series(np.append([months(value) for value in uniques], np.nan)[codes], index=frequencies.index, dtype=float)
+
+
+def next_maintenance(df:pd.DataFrame) -> pd.Series:
+    """ Date the next maintenance is due: last maintenance plus the maintenance period (NaT when one is unknown)"""
+    months = maintenance_months(df['Maintenance frequency'])
+    last = pd.to_datetime(df['Last maintenance'])
+    due = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    for period in months.dropna().unique():
+        rows = (months == period) & last.notna()
+        due[rows] = last[rows] + pd.DateOffset(months=int(period))
+    return due
+
+
+class _Snapshot:
+    """ A clean dataframe with what the queries filter on, computed once per load. Never modified once built:
+        a reload builds a new one, queries running on the previous one are not affected.
+    """
+
+    def __init__(self, df:pd.DataFrame, stamp:tuple, swapped:bool):
+        self.df = df
+        self.stamp = stamp
+        self.loaded_at = time.time()
+        # Row positions of each postal code, extracted once per distinct address
+        codes, addresses = pd.factorize(df['Address'])
+        postal_codes = pd.Series(addresses, dtype='string').str.extract(POSTAL_CODE, expand=False)
+        postal_codes = np.append(postal_codes.to_numpy(dtype=object, na_value=None), None)[codes]
+        self.postal_codes = pd.Series(np.arange(len(df))).groupby(postal_codes).indices
+        lat_column, lon_column = ('Longitude', 'Latitude') if swapped else ('Latitude', 'Longitude')
+        self.latitudes = df[lat_column].to_numpy(dtype=float, na_value=np.nan)
+        self.longitudes = df[lon_column].to_numpy(dtype=float, na_value=np.nan)
+        self.next_maintenance = next_maintenance(df).to_numpy()
+
+
+class CleanDataService:
+    """ Clean dataframe of a source file (raw csv, or clean Parquet/Arrow file), held in memory and queried by the
+        request handlers. reload() cleans the file again when it has changed; start() does it in a background thread.
+        workers, cache: passed to load_clean_data.
+    """
+
+    def __init__(self, data_path:str=loader.DATA_PATH, poll_interval:float=RELOAD_INTERVAL, workers:int=1,
+                 cache:loader.CleanDataCache=None, swapped:bool=COORDINATES_SWAPPED):
+        self.data_path = data_path
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.cache = cache
+        self.swapped = swapped
+        self.reloads = 0
+        self.last_error = None
+        self._snapshot = None
+        self._reload_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stamp(self) -> tuple:
+        stat = os.stat(self.data_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> bool:
+        """ Load and clean the source file if it changed since the last load. Returns whether it was loaded again."""
+        with self._reload_lock:
+            stamp = self._stamp()
+            if self._snapshot is not None and self._snapshot.stamp == stamp:
+                return False
+            df = loader.load_clean_data(self.data_path, workers=self.workers, cache=self.cache)
+            # Queries started before keep the previous snapshot, the next ones get this one
+            self._snapshot = _Snapshot(df, stamp, self.swapped)
+            self.reloads += 1
+            return True
+
+    def _poll(self) -> None:
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.reload()
+                self.last_error = None
+            except Exception as e:
+                # The previous frame keeps being served, e.g. while the source file is being replaced
+                self.last_error = repr(e)
+
+    def start(self) -> None:
+        """ Load the source file, then watch it from a background thread"""
+        self.reload()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._poll, name='clean-data-reload', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def snapshot(self) -> _Snapshot:
+        if self._snapshot is None:
+            self.reload()
+        return self._snapshot
+
+    def query(self, com_cp:list=None, overdue:bool=None, as_of=None, bbox:tuple=None, limit:int=DEFAULT_LIMIT,
+              offset:int=0) -> dict:
+        """ Page of the rows matching every given filter, in the order of the clean dataframe.
+            com_cp: postal codes of the address.
+            overdue: True for the rows whose next maintenance (see next_maintenance) was due before as_of
+                     (today by default), False for the other ones; rows without a known due date match neither.
+            bbox: (min_longitude, min_latitude, max_longitude, max_latitude).
+            Returns the total number of matching rows, the page and the offset of the next page (None on the last).
+        """
+        if not 1 <= limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+        if offset < 0:
+            raise ValueError("offset must be positive")
+        snapshot = self.snapshot
+
+        if com_cp:
+            rows = [snapshot.postal_codes.get(code, np.empty(0, dtype=np.int64)) for code in com_cp]
+            rows = np.unique(np.concatenate(rows))
+        else:
+            rows = np.arange(len(snapshot.df))
+        if overdue is not None:
+            due = snapshot.next_maintenance[rows]
+            as_of = np.datetime64(pd.Timestamp('today').normalize() if as_of is None else pd.Timestamp(as_of), 'ns')
+            rows = rows[~np.isnat(due) & ((due < as_of) == overdue)]
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            latitudes, longitudes = snapshot.latitudes[rows], snapshot.longitudes[rows]
+            rows = rows[(latitudes >= min_lat) & (latitudes <= max_lat) & (longitudes >= min_lon) & (longitudes <= max_lon)]
+
+        page = rows[offset:offset + limit]
+        records = json.loads(snapshot.df.iloc[page].to_json(orient='records', date_format='iso'))
+        return {'total': len(rows), 'offset': offset, 'limit': limit,
+                'next_offset': offset + limit if offset + limit < len(rows) else None, 'rows': records}
+
+    def status(self) -> dict:
+        snapshot = self.snapshot
+        return {'source': self.data_path, 'rows': len(snapshot.df), 'loaded_at': snapshot.loaded_at,
+                'reloads': self.reloads, 'last_error': self.last_error}
+
+
+def parse_query(query:str) -> dict:
+    """ Keyword arguments of CleanDataService.query from the query string of a request, ValueError when invalid:
+        com_cp=34000,34070 (or repeated), overdue=true|false, as_of=YYYY-MM-DD,
+        bbox=min_lon,min_lat,max_lon,max_lat, limit, offset
+    """
+    params = parse_qs(query, strict_parsing=False)
+    unknown = set(params) - {'com_cp', 'overdue', 'as_of', 'bbox', 'limit', 'offset'}
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    kwargs = {}
+    if 'com_cp' in params:
+        kwargs['com_cp'] = [code.strip() for value in params['com_cp'] for code in value.split(',') if code.strip()]
+    if 'overdue' in params:
+        value = params['overdue'][-1].lower()
+        if value not in ('true', 'false', '1', '0'):
+            raise ValueError("overdue must be true or false")
+        kwargs['overdue'] = value in ('true', '1')
+    if 'as_of' in params:
+        kwargs['as_of'] = pd.Timestamp(params['as_of'][-1])
+    if 'bbox' in params:
+        bbox = tuple(float(value) for value in params['bbox'][-1].split(','))
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        kwargs['bbox'] = bbox
+    for name in ('limit', 'offset'):
+        if name in params:
+            kwargs[name] = int(params[name][-1])
+    return kwargs
+
+
+class QueryServer(ThreadingHTTPServer):
+    """ HTTP server answering the queries of a CleanDataService:
+        GET /defibrillators?<filters> (see parse_query) and GET /status
+    """
+    daemon_threads = True
+
+    def __init__(self, service:CleanDataService, host:str=HOST, port:int=PORT):
+        super().__init__((host, port), QueryRequestHandler)
+        self.service = service
+
+    def url(self, path:str='') -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/{path}'
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, clients send many queries
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: without this, the body of every response waits for the delayed
+    # acknowledgement of the headers (about 40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status:int, content) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            if url.path == '/defibrillators':
+                self._send_json(200, self.server.service.query(**parse_query(url.query)))
+            elif url.path == '/status':
+                self._send_json(200, self.server.service.status())
+            else:
+                self._send_json(404, {'error': f"Unknown path {url.path}"})
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+
+
+def main(argv:list=None) -> int:
+    """ Command line entry point: serve until interrupted"""
+    parser = argparse.ArgumentParser(description="Serve the clean AED data over HTTP, reloaded when the source changes")
+    parser.add_argument('data_path', nargs='?', default=loader.DATA_PATH, help="raw csv, or clean Parquet/Arrow file")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--poll-interval', type=float, default=RELOAD_INTERVAL,
+                        help="seconds between two checks of the source file")
+    parser.add_argument('-j', '--workers', type=int, default=1, help="processes cleaning the source file")
+    args = parser.parse_args(argv)
+
+    service = CleanDataService(args.data_path, args.poll_interval, args.workers)
+    service.start()
+    server = QueryServer(service, args.host, args.port)
+    print(f"Serving {len(service.snapshot.df)} rows of {args.data_path} on {server.url()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+SAMPLE_DIRTY_FNAME = 'data/sample_dirty.csv'
+
+
+def test_next_maintenance():
+    from service import maintenance_months, next_maintenance
+    frequencies = pd.Series(['Tous les ans', 'Tous les 2 ans', 'tous les 6 mois', 'à la demande', None], dtype='string')
+    assert maintenance_months(frequencies).tolist()[:4] == [12, 24, 6, pytest.approx(float('nan'), nan_ok=True)]
+    df = pd.DataFrame({'Maintenance frequency': frequencies,
+                       'Last maintenance': pd.to_datetime(['2019-01-31', '2019-05-15', '2019-05-15', '2019-05-15', '2019-05-15'])})
+    assert next_maintenance(df).tolist()[:3] == [pd.Timestamp('2020-01-31'), pd.Timestamp('2021-05-15'), pd.Timestamp('2019-11-15')]
+    assert next_maintenance(df)[3:].isna().all()
+
+
+def test_query():
+    from service import CleanDataService
+    service = CleanDataService(SAMPLE_DIRTY_FNAME)
+
+    def rows(**kwargs):
+        return [row['Name'] for row in service.query(**kwargs)['rows']]
+
+    names = service.snapshot.df['Name']
+    assert rows(com_cp=['34070']) == names[[2, 13]].tolist()
+    assert rows(com_cp=['34070', '34999']) == names[[2, 13]].tolist()
+    # Yearly maintenances: due a year after the last one
+    assert rows(overdue=True, as_of='2020-06-01') == names[[0, 6, 10]].tolist()
+    assert rows(overdue=False, as_of='2020-06-01') == names[[2, 4, 12, 13]].tolist()
+    # Latitude and Longitude are swapped in the clean data, the bounding box is in longitude/latitude order
+    assert rows(bbox=(3.85, 43.59, 3.90, 43.61)) == names[[4, 6, 12, 13]].tolist()
+    assert rows(com_cp=['34000'], overdue=False, as_of='2020-06-01', bbox=(3.85, 43.59, 3.90, 43.61)) == names[[4, 12]].tolist()
+
+    first = service.query(limit=5)
+    assert (first['total'], first['offset'], first['next_offset'], len(first['rows'])) == (14, 0, 5, 5)
+    last = service.query(limit=5, offset=10)
+    assert last['next_offset'] is None and len(last['rows']) == 4
+    assert last['rows'][0] == {'Name': 'Gymnase François Spinosi', 'Address': 'Rue Pierre Gilles de Gennes 34000 Montpellier',
+                               'Phone number': '+33 4 67 15 90 35', 'Maintenance frequency': 'Tous les ans',
+                               'Last maintenance': '2018-12-06T00:00:00.000', 'Latitude': 3.9177155917, 'Longitude': 43.5989740314}
+    with pytest.raises(ValueError):
+        service.query(limit=0)
+
+
+def test_parse_query():
+    from service import parse_query
+    assert parse_query('com_cp=34000,34070&com_cp=34080&overdue=true&as_of=2020-06-01&bbox=3.8,43.5,3.9,43.7&limit=5&offset=10') == {
+        'com_cp': ['34000', '34070', '34080'], 'overdue': True, 'as_of': pd.Timestamp('2020-06-01'),
+        'bbox': (3.8, 43.5, 3.9, 43.7), 'limit': 5, 'offset': 10}
+    assert parse_query('') == {}
+    for query in ['overdue=maybe', 'bbox=3.9,43.5,3.8,43.7', 'bbox=1,2,3', 'limit=ten', 'as_of=never', 'city=Montpellier']:
+        with pytest.raises(ValueError):
+            parse_query(query)
+
+
+def test_query_server_and_reload(tmp_path):
+    import requests
+    from service import CleanDataService, QueryServer
+    data_fname = tmp_path / 'dirty.csv'
+    shutil.copy(SAMPLE_DIRTY_FNAME, data_fname)
+    service = CleanDataService(str(data_fname), poll_interval=0.05)
+    service.start()
+    server = QueryServer(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with requests.Session() as session:
+            response = session.get(server.url('defibrillators'), params={'com_cp': '34070', 'limit': 1})
+            assert response.status_code == 200
+            assert response.json()['total'] == 2 and response.json()['next_offset'] == 1
+            assert session.get(server.url('defibrillators?overdue=maybe')).status_code == 400
+            assert session.get(server.url('other')).status_code == 404
+            assert session.get(server.url('status')).json()['rows'] == 14
+
+            # The source file changes: it is cleaned again in the background
+            lines = data_fname.read_text(encoding='utf-8').splitlines(keepends=True)
+            data_fname.write_text(''.join(lines + lines[1:3]), encoding='utf-8')
+            os.utime(data_fname, ns=(time.time_ns(), time.time_ns() + 10**9))
+            deadline = time.monotonic() + 10
+            while service.reloads < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            status = session.get(server.url('status')).json()
+            assert (status['rows'], status['reloads'], status['last_error']) == (16, 2, None)
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.stop()
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+# Mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0088
+
+# In the Montpellier export, lat_coor1 (cleaned as 'Latitude') holds the longitude and long_coor1
+# (cleaned as 'Longitude') the latitude: by default the columns are read the other way round.
+COORDINATES_SWAPPED = True
+
+# Size of the cells of the grid index, in degrees (about 1 km of latitude)
+CELL_SIZE = 0.01
+
+# Number of queries whose distances to every defibrillator are computed at once in batch queries
+BATCH_BLOCK_SIZE = 256
+# Above this number of defibrillators, batch queries go through the grid one location at a time,
+# which is cheaper than the full distance matrices
+BATCH_MAX_POINTS = 20_000
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in km between points given in degrees (NumPy broadcasting applies)"""
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class DefibrillatorIndex:
+    """ Grid index over defibrillator positions, answering nearest and within-radius queries.
+        Points are sorted by grid cell, so that the points of a row of cells are a contiguous slice:
+        a query only computes the distances to the points of the cells around it.
+        Queries return the distances in km and the index labels of the matching rows of the indexed frame.
+    """
+
+    def __init__(self, latitudes, longitudes, labels=None, cell_size:float=CELL_SIZE):
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        labels = np.arange(len(latitudes)) if labels is None else np.asarray(labels)
+        # Rows without coordinates cannot be found
+        known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        if np.any(np.abs(latitudes[known]) > 90):
+            raise ValueError("Latitudes must be between -90 and 90 degrees, are the coordinates columns swapped?")
+
+        self.cell_size = cell_size
+        self._n_lon_cells = int(np.ceil(360 / cell_size))
+        cells = self._cell_ids(latitudes[known], longitudes[known])
+        order = np.argsort(cells, kind='stable')
+        self._cells = cells[order]
+        self.latitudes = latitudes[known][order]
+        self.longitudes = longitudes[known][order]
+        self.labels = labels[known][order]
+
+    @classmethod
+    def from_clean_data(cls, df:pd.DataFrame, swapped:bool=COORDINATES_SWAPPED, cell_size:float=CELL_SIZE):
+        """ Index the rows of a load_clean_data dataframe.
+            swapped: the 'Latitude' column holds longitudes and the 'Longitude' column latitudes, as in the raw export.
+        """
+        lat_column, lon_column = ('Longitude', 'Latitude') if swapped else ('Latitude', 'Longitude')
+        return cls(df[lat_column].to_numpy(dtype=float), df[lon_column].to_numpy(dtype=float), df.index, cell_size)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _cell_rows(self, latitudes):
+        return np.floor(np.asarray(latitudes) / self.cell_size).astype(np.int64)
+
+    def _cell_columns(self, longitudes):
+        return np.floor((np.asarray(longitudes) + 180) % 360 / self.cell_size).astype(np.int64)
+
+    def _cell_ids(self, latitudes, longitudes):
+        return self._cell_rows(latitudes) * self._n_lon_cells + self._cell_columns(longitudes)
+
+    def _candidates(self, lat:float, lon:float, radius:float) -> np.ndarray:
+        """ Positions of the points of every cell of the bounding box of the circle"""
+        angle = radius / EARTH_RADIUS
+        delta_lat = np.degrees(angle)
+        rows = np.arange(self._cell_rows(max(lat - delta_lat, -90)), self._cell_rows(min(lat + delta_lat, 90)) + 1)
+        # Longitude span of the circle, or every longitude when it contains a pole
+        sin_ratio = np.sin(min(angle, np.pi / 2)) / np.cos(np.radians(lat))
+        if lat + delta_lat >= 90 or lat - delta_lat <= -90 or sin_ratio >= 1:
+            column_ranges = [(0, self._n_lon_cells - 1)]
+        else:
+            delta_lon = np.degrees(np.arcsin(sin_ratio))
+            first, last = self._cell_columns(lon - delta_lon), self._cell_columns(lon + delta_lon)
+            # The box may cross the antimeridian
+            column_ranges = [(first, last)] if first <= last else [(first, self._n_lon_cells - 1), (0, last)]
+
+        slices = []
+        for first, last in column_ranges:
+            starts = np.searchsorted(self._cells, rows * self._n_lon_cells + first, side='left')
+            ends = np.searchsorted(self._cells, rows * self._n_lon_cells + last, side='right')
+            slices.extend(np.arange(start, end) for start, end in zip(starts, ends) if end > start)
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def within(self, lat:float, lon:float, radius:float):
+        """ Defibrillators at most radius km away from (lat, lon), closest first"""
+        candidates = self._candidates(lat, lon, radius)
+        distances = haversine(lat, lon, self.latitudes[candidates], self.longitudes[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return distances[order], self.labels[candidates[order]]
+
+    def nearest(self, lat:float, lon:float, k:int=1):
+        """ The k defibrillators closest to (lat, lon), closest first"""
+        k = min(k, len(self))
+        radius = self.cell_size * np.pi / 180 * EARTH_RADIUS
+        # Every point within the radius is found: once there are k of them, they are the k nearest
+        while True:
+            distances, labels = self.within(lat, lon, radius)
+            if len(distances) >= k or radius >= np.pi * EARTH_RADIUS:
+                return distances[:k], labels[:k]
+            radius *= 2
+
+    def nearest_batch(self, latitudes, longitudes, k:int=1, block_size:int=BATCH_BLOCK_SIZE):
+        """ The k closest defibrillators of many locations at once, with NumPy distance matrices
+            computed block by block (or grid queries on large indexes, see BATCH_MAX_POINTS).
+            Returns arrays of distances and labels of shape (n_locations, k).
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        k = min(k, len(self))
+        distances = np.empty((len(latitudes), k))
+        if k == 0:
+            return distances, self.labels[:0].reshape(len(latitudes), 0)
+        if len(self) > BATCH_MAX_POINTS:
+            labels = np.empty((len(latitudes), k), dtype=self.labels.dtype)
+            for i, (lat, lon) in enumerate(zip(latitudes, longitudes)):
+                distances[i], labels[i] = self.nearest(lat, lon, k)
+            return distances, labels
+        positions = np.empty((len(latitudes), k), dtype=np.int64)
+        for start in range(0, len(latitudes), block_size):
+            block = slice(start, start + block_size)
+            matrix = haversine(latitudes[block, None], longitudes[block, None], self.latitudes[None, :], self.longitudes[None, :])
+            closest = np.argpartition(matrix, k - 1, axis=1)[:, :k] if k < len(self) else np.tile(np.arange(k), (len(matrix), 1))
+            closest_distances = np.take_along_axis(matrix, closest, axis=1)
+            order = np.argsort(closest_distances, axis=1, kind='stable')
+            distances[block] = np.take_along_axis(closest_distances, order, axis=1)
+            positions[block] = np.take_along_axis(closest, order, axis=1)
+        return distances, self.labels[positions]
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def clean_data():
+    from loader import DATA_PATH, load_clean_data
+    return load_clean_data(DATA_PATH)
+
+
+@pytest.fixture
+def locations():
+    rng = np.random.default_rng(0)
+    return rng.uniform(43.55, 43.68, 50), rng.uniform(3.78, 3.98, 50)
+
+
+def brute_force(clean_data, lat, lon):
+    from spatial import haversine
+    # Latitude and Longitude are swapped in the Montpellier export
+    return haversine(lat, lon, clean_data['Longitude'], clean_data['Latitude']).dropna().sort_values()
+
+
+def test_nearest_and_within(clean_data, locations):
+    from spatial import DefibrillatorIndex
+    index = DefibrillatorIndex.from_clean_data(clean_data)
+    assert len(index) == clean_data[['Latitude', 'Longitude']].notna().all(axis=1).sum()
+    for lat, lon in zip(*locations):
+        expected = brute_force(clean_data, lat, lon)
+        distances, labels = index.nearest(lat, lon, k=3)
+        assert np.allclose(distances, expected.iloc[:3])
+        assert np.allclose(distances, brute_force(clean_data.loc[labels], lat, lon))
+        distances, labels = index.within(lat, lon, 1.5)
+        assert np.allclose(distances, expected[expected <= 1.5])
+
+
+def test_nearest_batch(clean_data, locations):
+    import spatial
+    index = spatial.DefibrillatorIndex.from_clean_data(clean_data)
+    distances, labels = index.nearest_batch(*locations, k=2, block_size=16)
+    assert distances.shape == labels.shape == (50, 2)
+    for i, (lat, lon) in enumerate(zip(*locations)):
+        assert np.allclose(distances[i], index.nearest(lat, lon, k=2)[0])
+
+
+def test_swapped_columns(clean_data):
+    from spatial import DefibrillatorIndex
+    # Read as they are named, the Montpellier coordinates are somewhere near Somalia
+    index = DefibrillatorIndex.from_clean_data(clean_data, swapped=False)
+    assert index.nearest(43.61, 3.88)[0][0] > 4000
+    with pytest.raises(ValueError):
+        DefibrillatorIndex([120.0], [3.9])